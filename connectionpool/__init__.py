@@ -6,11 +6,43 @@ from .connectionpool import (
 	PoolIsEmptyError,
 	PoolIsClosedError,
 	ConnectionWrapper,
+	PoolHooks,
 	SingleHostConnectionPool,
 	ConnectionPool,
 )
 
+from .singleflight import (
+	SingleFlight,
+)
+
+from .tracing import (
+	RequestTrace,
+	Tracer,
+	OpenTelemetryTracer,
+)
+
+from .httpcache import (
+	HTTPResponseCache,
+	CachedResponse,
+)
+
+from .replicaset import (
+	ReplicaSetPool,
+)
+
 from .httpconnectionpool import (
 	HTTPConnectionPool,
 	HTTPSingleHostConnectionPool,
+	HTTPReplicaSetPool,
+)
+
+from .http2connectionpool import (
+	HTTP2ConnectionPool,
+	HTTP2SingleHostConnectionPool,
+	HTTP2StreamError,
+)
+
+from .broker import (
+	PoolBroker,
+	BrokerClient,
 )
@@ -0,0 +1,323 @@
+# Local pool broker: one process owns upstream connections and lends
+# their sockets to worker processes over a Unix socket (SCM_RIGHTS).
+#
+# This module is part of python-connectionpool and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php
+
+
+import os
+import select
+import socket
+import struct
+import threading
+import SocketServer
+
+from _multiprocessing import sendfd, recvfd
+
+from .connectionpool import (
+	ConnectionPool,
+	ConnectionWrapper,
+	PoolIsEmptyError,
+)
+
+
+_OP_GET, _OP_PUT, _OP_DROP = 1, 2, 3
+_STATUS_OK, _STATUS_EMPTY, _STATUS_ERROR = "+", "-", "!"
+_HEADER = struct.Struct("!BH")
+# Address family sent ahead of each descriptor
+_FAMILY = struct.Struct("!H")
+
+
+def _recv_exact(sock, size):
+	"""Read exactly size bytes from stream socket"""
+
+	data = ""
+	while len(data) < size:
+		chunk = sock.recv(size - len(data))
+		if not chunk:
+			raise EOFError()
+		data += chunk
+	return data
+
+
+def _send_request(sock, op, host, port):
+	payload = "{0}\n{1}".format(host, "" if port is None else port)
+	sock.sendall(_HEADER.pack(op, len(payload)) + payload)
+
+
+def _recv_request(sock):
+	op, size = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+	host, port = _recv_exact(sock, size).split("\n", 1)
+	return op, host, (int(port) if port.isdigit() else (port or None))
+
+
+def _wait_channel(channel, writable=False):
+	"""Wait until channel with timeout (non blocking) is ready for sendfd/recvfd"""
+
+	timeout = channel.gettimeout()
+	if timeout is None:
+		return
+	ready = select.select([], [channel], [], timeout)[1] if writable else \
+		select.select([channel], [], [], timeout)[0]
+	if not ready:
+		raise socket.timeout("timed out")
+
+
+def _send_socket(channel, sock):
+	channel.sendall(_FAMILY.pack(sock.family))
+	_wait_channel(channel, writable=True)
+	sendfd(channel.fileno(), sock.fileno())
+
+
+def _recv_socket(channel):
+	"""Receive socket sent by _send_socket, wrapped with its own address family"""
+
+	family, = _FAMILY.unpack(_recv_exact(channel, _FAMILY.size))
+	# Descriptor may arrive after family bytes
+	_wait_channel(channel)
+	fd = recvfd(channel.fileno())
+	try:
+		# Raw socket from fromfd has makefile() ignoring timeouts, httplib needs wrapper
+		return socket.socket(_sock=socket.fromfd(fd, family, socket.SOCK_STREAM))
+	finally:
+		os.close(fd)
+
+
+class _SocketWrapper(ConnectionWrapper):
+
+	def ok(self):
+		# Idle connection must not be readable: it means EOF or stray data
+		try:
+			readable, _, _ = select.select([self.conn], [], [], 0)
+		except (select.error, socket.error, ValueError):
+			return False
+		return not readable
+
+	def close(self):
+		self.conn.close()
+
+
+def _create_socket(host, port=None, conn_timeout=None):
+	"""Create new upstream socket"""
+
+	return socket.create_connection((host, port or 80), conn_timeout)
+
+
+class _BrokerRequestHandler(SocketServer.BaseRequestHandler):
+	"""Serve one worker channel, remembering what it has borrowed"""
+
+	def setup(self):
+		with self.server.lock:
+			self.server.channels.add(self.request)
+
+	def finish(self):
+		with self.server.lock:
+			self.server.channels.discard(self.request)
+
+	def handle(self):
+		pools = self.server.pools
+		lent = []
+		try:
+			while True:
+				op, host, port = _recv_request(self.request)
+				if op == _OP_GET:
+					pool = pools.get(host, port)
+					if self.__lend(pool):
+						lent.append(((host, port), pool))
+				elif op in (_OP_PUT, _OP_DROP):
+					conn = None
+					if op == _OP_PUT:
+						conn = _SocketWrapper(_recv_socket(self.request))
+					pool = self.__forget(lent, (host, port))
+					if pool is None or (conn and not conn.ok()):
+						if conn:
+							conn.close()
+						conn = None
+					if pool is not None:
+						pool._put_conn(conn)
+					# Worker goes on once connection is available to others again
+					self.request.sendall(_STATUS_OK)
+		except (EOFError, socket.error, OSError, struct.error, ValueError):
+			pass
+		finally:
+			# Worker went away, slots of its borrowed connections are free again
+			for _, pool in lent:
+				pool._put_conn(None)
+
+	def __lend(self, pool):
+		try:
+			conn = pool._get_conn()
+		except PoolIsEmptyError:
+			self.request.sendall(_STATUS_EMPTY)
+			return False
+		except socket.error:
+			self.request.sendall(_STATUS_ERROR)
+			return False
+
+		try:
+			self.request.sendall(_STATUS_OK)
+			_send_socket(self.request, conn.conn)
+		except:
+			pool._put_conn(conn)
+			raise
+
+		# Worker holds its own descriptor now
+		conn.close()
+		return True
+
+	@staticmethod
+	def __forget(lent, key):
+		for i, (lent_key, pool) in enumerate(lent):
+			if lent_key == key:
+				del lent[i]
+				return pool
+		return None
+
+
+class _BrokerServer(SocketServer.ThreadingUnixStreamServer):
+	daemon_threads = True
+
+	def __init__(self, path, handler):
+		SocketServer.ThreadingUnixStreamServer.__init__(self, path, handler)
+		self.lock = threading.Lock()
+		self.channels = set()
+
+	def close_channels(self):
+		"""Disconnect all workers, their handlers reclaim what was lent"""
+
+		with self.lock:
+			channels = list(self.channels)
+		for channel in channels:
+			try:
+				channel.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+
+
+class PoolBroker:
+	"""Owns single host pools and lends their sockets to local processes"""
+
+	def __init__(
+		self, path, connection_factory=None, conn_timeout=None,
+		cache_size=100, pool_size=100, pool_block=False, pool_timeout=None):
+
+		if connection_factory is None:
+			connection_factory = lambda host, port: _create_socket(host, port, conn_timeout)
+
+		self.__path = path
+		self.__pools = ConnectionPool(
+			lambda host, port: _SocketWrapper(connection_factory(host, port)),
+			cache_size=cache_size,
+			pool_size=pool_size, pool_block=pool_block, pool_timeout=pool_timeout)
+
+		if os.path.exists(path):
+			os.unlink(path)
+		self.__server = _BrokerServer(path, _BrokerRequestHandler)
+		self.__server.pools = self.__pools
+		self.__thread = None
+
+	def get_path(self):
+		"""Return path of broker Unix socket"""
+
+		return self.__path
+
+	def serve_forever(self):
+		"""Serve worker requests until broker is closed"""
+
+		self.__server.serve_forever()
+
+	def start(self):
+		"""Serve worker requests in background thread"""
+
+		self.__thread = threading.Thread(target=self.serve_forever)
+		self.__thread.daemon = True
+		self.__thread.start()
+
+	def close(self):
+		"""Stop serving and close all pooled connections"""
+
+		if self.__thread is not None:
+			self.__server.shutdown()
+			self.__thread.join()
+			self.__thread = None
+		self.__server.close_channels()
+		self.__server.server_close()
+		if os.path.exists(self.__path):
+			os.unlink(self.__path)
+		self.__pools.clear()
+
+
+class BrokerClient:
+	"""Borrows sockets from PoolBroker running in another process"""
+
+	def __init__(self, path, timeout=None):
+		self.__path = path
+		self.__timeout = timeout
+		self.__channel = None
+		self.__lock = threading.Lock()
+
+	def __connect(self):
+		if self.__channel is None:
+			channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				channel.settimeout(self.__timeout)
+				channel.connect(self.__path)
+			except:
+				channel.close()
+				raise
+			self.__channel = channel
+		return self.__channel
+
+	def __reset(self):
+		channel, self.__channel = self.__channel, None
+		if channel is not None:
+			channel.close()
+
+	def acquire(self, host, port=None):
+		"""Borrow socket from broker, returns None if broker is unavailable"""
+
+		with self.__lock:
+			try:
+				channel = self.__connect()
+				_send_request(channel, _OP_GET, host, port)
+				status = _recv_exact(channel, 1)
+				sock = _recv_socket(channel) if status == _STATUS_OK else None
+			except (EOFError, socket.error, OSError, struct.error):
+				self.__reset()
+				return None
+
+		if status == _STATUS_EMPTY:
+			raise PoolIsEmptyError()
+		return sock
+
+	def release(self, host, port, sock):
+		"""Return borrowed socket to broker, waits until other workers can borrow it"""
+
+		try:
+			with self.__lock:
+				try:
+					channel = self.__connect()
+					_send_request(channel, _OP_PUT, host, port)
+					_send_socket(channel, sock)
+					_recv_exact(channel, 1)
+				except (EOFError, socket.error, OSError):
+					self.__reset()
+		finally:
+			sock.close()
+
+	def discard(self, host, port):
+		"""Tell broker that borrowed socket is gone"""
+
+		with self.__lock:
+			try:
+				channel = self.__connect()
+				_send_request(channel, _OP_DROP, host, port)
+				_recv_exact(channel, 1)
+			except (EOFError, socket.error, OSError):
+				self.__reset()
+
+	def close(self):
+		"""Close channel to broker, broker reclaims everything borrowed"""
+
+		with self.__lock:
+			self.__reset()
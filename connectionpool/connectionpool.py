@@ -8,9 +8,12 @@
 import logging
 import socket
 import httplib
+import threading
+import time
 import Queue
 
 from .lrucache import LRUCache
+from .singleflight import SingleFlight
 
 
 class PoolIsEmptyError(Exception):
@@ -38,6 +41,10 @@ class PoolBrokenConnectionError(Exception):
 class ConnectionWrapper:
 	"""Base class for connection wrapper"""
 
+	# Maintained by pool when PoolHooks validation policy is in use
+	idle_since = 0.0
+	unvalidated_uses = 0
+
 	def __init__(self, conn):
 		self.conn = conn
 
@@ -52,13 +59,67 @@ class ConnectionWrapper:
 		pass
 
 
+class PoolHooks:
+	"""Connection lifecycle hooks and validation policy
+
+	Base class hooks do nothing.  By default ok() is called on every
+	checkout; with validate_idle and/or validate_uses it is called only
+	for connections idle longer than validate_idle seconds or used
+	validate_uses times since last validation.  With async_checkin
+	on_checkin runs in background thread instead of request thread.
+	"""
+
+	def __init__(self, validate_idle=None, validate_uses=None, async_checkin=False):
+		self.validate_idle = validate_idle
+		self.validate_uses = validate_uses
+		self.async_checkin = async_checkin
+
+	def needs_validation(self, conn, now):
+		"""Decide whether idle connection has to be checked with ok()"""
+
+		if self.validate_idle is None and self.validate_uses is None:
+			return True
+		if self.validate_idle is not None and now - conn.idle_since > self.validate_idle:
+			return True
+		if self.validate_uses is not None and conn.unvalidated_uses >= self.validate_uses:
+			return True
+		return False
+
+	def on_create(self, conn):
+		"""Called for new connection before its first checkout"""
+
+		pass
+
+	def on_checkout(self, conn):
+		"""Called before connection is handed to request"""
+
+		pass
+
+	def on_checkin(self, conn):
+		"""Reset connection before it goes back to pool, raise to discard it"""
+
+		pass
+
+	def on_discard(self, conn):
+		"""Called before pool closes connection"""
+
+		pass
+
+
 class SingleHostConnectionPool:
 	"""Connection pool for one target location"""
 
 	def __init__(self, connection_factory,
-		pool_size=1, pool_block=False, pool_timeout=None):
+		pool_size=1, pool_block=False, pool_timeout=None, tracer=None, hooks=None):
 
 		self.__connection_factory = connection_factory
+		self.__tracer = tracer
+		self.__hooks = hooks
+		self.__checkin_lock = threading.Lock()
+		self.__checkin_queue = None
+		# Connections handed to checkin thread but not yet back in pool
+		self.__checkin_pending = 0
+		self.__checkin_done = threading.Condition(self.__checkin_lock)
 
 		self.__pool_size = pool_size
 		self.__pool_block = pool_block
@@ -74,57 +135,195 @@ class SingleHostConnectionPool:
 
 		return self.__pool_size
 
-	def _get_conn(self):
+	def get_tracer(self):
+		"""Return tracer of this pool or None if tracing is disabled"""
+
+		return self.__tracer
+
+	def get_hooks(self):
+		"""Return lifecycle hooks of this pool or None"""
+
+		return self.__hooks
+
+	def _get_conn(self, trace=None):
 		"""Obtain an existing connection or create a new one"""
 
-		conn = None
 		try:
 			conn = self.__pool.get(block=self.__pool_block, timeout=self.__pool_timeout)
-			if conn and not conn.ok():
-				conn.close()
+		except AttributeError as e: # self.__pool is None
+			raise PoolIsClosedError()
+		except Queue.Empty:
+			if self.__pool_block:
+				raise PoolIsEmptyError()
+			conn = self.__wait_checkin()
+
+		hooks = self.__hooks
+		if conn and (hooks is None or hooks.needs_validation(conn, time.time())):
+			if not conn.ok():
+				self._discard(conn)
 				conn = None
+			elif hooks is not None:
+				conn.unvalidated_uses = 0
+
+		if trace is not None:
+			trace.mark("pool_wait")
+
+		created = not conn
+		try:
+			if created:
+				conn = self.__connection_factory()
+				if hooks is not None:
+					hooks.on_create(conn)
+			if hooks is not None:
+				conn.unvalidated_uses += 1
+				hooks.on_checkout(conn)
+		except:
+			# Give the slot back, connection (if any) is unusable
+			if conn:
+				self._discard(conn)
+			self.__return(None)
+			raise
+
+		if trace is not None:
+			trace.checkout(conn, created)
+		return conn
+
+	def __wait_checkin(self):
+		"""Wait for connections still being checked in, they are not missing from pool"""
+
+		with self.__checkin_done:
+			while self.__checkin_pending:
+				self.__checkin_done.wait()
+		# Every checkin done so far already returned its connection
+		try:
+			return self.__pool.get(block=False)
 		except AttributeError as e: # self.__pool is None
 			raise PoolIsClosedError()
 		except Queue.Empty:
 			raise PoolIsEmptyError()
 
-		return conn or self.__connection_factory()
-
 	def _put_conn(self, conn):
 		"""Return connection back to pool"""
 
+		if conn is None or self.__hooks is None:
+			self.__return(conn)
+		elif self.__hooks.async_checkin:
+			self.__checkin_async(conn)
+		else:
+			self.__checkin(conn)
+
+	def _discard(self, conn):
+		"""Close connection which will not be reused"""
+
+		if self.__hooks is not None:
+			self.__hooks.on_discard(conn)
+		conn.close()
+
+	def __return(self, conn):
 		try:
 			self.__pool.put(conn)
 		except Exception as e:
-			conn.close()
+			if conn:
+				self._discard(conn)
+
+	def __checkin(self, conn):
+		try:
+			self.__hooks.on_checkin(conn)
+		except Exception as e:
+			logging.getLogger(__name__).warning("Discarding connection, checkin failed: %s", e)
+			self._discard(conn)
+			conn = None
+		else:
+			conn.idle_since = time.time()
+		self.__return(conn)
+
+	def __checkin_async(self, conn):
+		with self.__checkin_lock:
+			if self.__pool is None:
+				queue = None
+			elif self.__checkin_queue is None:
+				queue = self.__checkin_queue = Queue.Queue()
+				thread = threading.Thread(target=self.__checkin_loop, args=(queue,))
+				thread.daemon = True
+				thread.start()
+			else:
+				queue = self.__checkin_queue
+			if queue is not None:
+				self.__checkin_pending += 1
+
+		if queue is None:
+			self._discard(conn)
+		else:
+			queue.put(conn)
+
+	def __checkin_loop(self, queue):
+		"""Reset returned connections off the request path"""
+
+		while True:
+			conn = queue.get()
+			if conn is None:
+				return
+			try:
+				self.__checkin(conn)
+			except Exception:
+				logging.getLogger(__name__).exception("Connection checkin failed")
+			finally:
+				with self.__checkin_done:
+					self.__checkin_pending -= 1
+					self.__checkin_done.notify_all()
 
 	def close(self):
 		"""Close connection pool"""
 
 		oldpool, self.__pool = self.__pool, None
+		with self.__checkin_lock:
+			queue, self.__checkin_queue = self.__checkin_queue, None
+		if queue is not None:
+			queue.put(None)
+
 		try:
 			while True:
 				conn = oldpool.get(block=False)
 				if conn:
-					conn.close()
+					self._discard(conn)
 		except Queue.Empty:
 			pass
 
 	def request(self, callback):
 		"""Get HTTP request from pool and pass it to callback"""
 
+		trace = None if self.__tracer is None else self.__tracer.start("request")
+		if trace is None:
+			return self._request(callback)
+
+		try:
+			result = self._request(callback, trace)
+		except Exception as e:
+			self.__tracer.fail(trace, e)
+			raise
+		self.__tracer.finish(trace)
+		return result
+
+	def _request(self, callback, trace=None):
+		"""Pass pooled connection to callback, retrying once on broken connection
+
+		trace, if given, was already sampled by caller.
+		"""
+
 		retries = 2
 		while retries > 0:
 			retries -= 1
-			conn = self._get_conn()
+			conn = self._get_conn() if trace is None else self._get_conn(trace)
 			try:
 				return callback(conn)
 			except PoolBrokenConnectionError as e:
 				# Possible problems with pooled connections, give a second chance
-				conn.close()
+				self._discard(conn)
 				conn = None
 				if retries == 0:
 					raise e.expt
+				if trace is not None:
+					trace.retries += 1
 			finally:
 				self._put_conn(conn)
 
@@ -136,7 +335,8 @@ class ConnectionPool:
 
 	def __init__(
 		self, connection_factory,
-		cache_size=100, pool_size=1, pool_block=False, pool_timeout=None):
+		cache_size=100, pool_size=1, pool_block=False, pool_timeout=None, tracer=None,
+		hooks=None):
 
 		self.__cache_size = cache_size
 		self.__cache = LRUCache(cache_size=self.__cache_size, disposefunc=lambda p: p.close())
@@ -145,6 +345,9 @@ class ConnectionPool:
 		self.__pool_size = pool_size
 		self.__pool_block = pool_block
 		self.__pool_timeout = pool_timeout
+		self.__tracer = tracer
+		self.__hooks = hooks
+		self.__pools_in_flight = SingleFlight()
 
 	def get_cache_max_size(self):
 		"""Return maximum possible size of LRU cache"""
@@ -166,13 +369,24 @@ class ConnectionPool:
 
 		pool_key = (host, port)
 
+		pool = self.__cache.get(pool_key)
+		if pool:
+			return pool
+
+		# Concurrent first requests to a host must end up with the same pool
+		return self.__pools_in_flight.do(pool_key, lambda: self.__create_pool(host, port))
+
+	def __create_pool(self, host, port):
+		pool_key = (host, port)
+
 		pool = self.__cache.get(pool_key)
 		if pool:
 			return pool
 
 		pool = self.SingleHostPoolCls(
 			lambda: self.__connection_factory(host, port),
-			pool_size=self.__pool_size, pool_block = self.__pool_block, pool_timeout = self.__pool_timeout)
+			pool_size=self.__pool_size, pool_block = self.__pool_block, pool_timeout = self.__pool_timeout,
+			tracer=self.__tracer, hooks=self.__hooks)
 		self.__cache[pool_key] = pool
 
 		return pool
@@ -0,0 +1,674 @@
+# HTTP/2 connection pool: concurrent requests to one host share a few
+# multiplexed connections instead of holding a socket each.
+# Requires the h2 package (https://github.com/python-hyper/hyper-h2).
+#
+# This module is part of python-connectionpool and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php
+
+
+import httplib
+import select
+import socket
+import threading
+import time
+
+try:
+	import h2.config
+	import h2.connection
+	import h2.errors
+	import h2.events
+	import h2.exceptions
+except ImportError:
+	h2 = None
+
+from .connectionpool import (
+	ConnectionPool,
+	ConnectionWrapper,
+	PoolIsClosedError,
+	PoolIsEmptyError,
+)
+from .httpconnectionpool import (
+	HTTPConnectionPool,
+	HTTPSingleHostConnectionPool,
+)
+
+
+class HTTP2StreamError(Exception):
+	"""Notifies clients that request stream was reset"""
+
+	def __init__(self, error_code):
+		self.error_code = error_code
+		Exception.__init__(self, "Stream reset with error code {0}.".format(error_code))
+
+
+# Connection specific headers are forbidden in HTTP/2
+_CONNECTION_HEADERS = frozenset([
+	"connection", "host", "keep-alive", "proxy-connection", "transfer-encoding", "upgrade"])
+
+_BLOCK_SIZE = 65536
+# Largest flow control window allowed by RFC 7540
+_MAX_WINDOW = 2 ** 31 - 1
+
+
+def _require_h2():
+	if h2 is None:
+		raise ImportError("HTTP/2 support requires the h2 package.")
+
+
+class _HTTP2Stream:
+
+	def __init__(self):
+		self.id = None
+		self.status = None
+		self.headers = []
+		self.data = []
+		self.buffered = 0
+		self.ended = False
+		self.finished = False
+		self.error = None
+
+
+class _RewindableBody:
+	"""File-like request body which is sent from its start on every attempt"""
+
+	def __init__(self, fileobj):
+		self.__file = fileobj
+		try:
+			self.__start = fileobj.tell()
+		except (AttributeError, IOError):
+			self.__start = None
+		self.__started = False
+
+	def read(self, size):
+		self.__started = True
+		return self.__file.read(size)
+
+	def rewind(self):
+		"""Seek back to start of body, returns False if it can not be replayed"""
+
+		if not self.__started:
+			return True
+		if self.__start is None:
+			return False
+		try:
+			self.__file.seek(self.__start)
+		except (AttributeError, IOError):
+			return False
+		return True
+
+
+class HTTP2Response:
+	"""Response of one HTTP/2 stream, mimics httplib.HTTPResponse"""
+
+	version = 20
+	reason = ""
+
+	def __init__(self, conn, stream):
+		self.__conn = conn
+		self.__stream = stream
+		self.status = stream.status
+
+	def getheader(self, name, default=None):
+		name = name.lower()
+		values = [ v for k, v in self.__stream.headers if k == name ]
+		return ", ".join(values) if values else default
+
+	def getheaders(self):
+		return list(self.__stream.headers)
+
+	def read(self, amt=None):
+		return self.__conn._read(self.__stream, amt)
+
+	def close(self):
+		self.__conn._cancel(self.__stream)
+
+
+class _HTTP2Connection:
+	"""HTTP/2 connection shared by concurrent streams
+
+	A reader thread processes incoming frames; h2 state, HPACK tables and
+	socket io are guarded by one condition which request threads wait on.
+	"""
+
+	def __init__(self, sock, authority, scheme="http", max_streams=100,
+		conn_timeout=None, net_timeout=None):
+
+		self.sock = sock
+		self.authority = authority
+		self.scheme = scheme
+		self.max_streams = max_streams
+		self.net_timeout = net_timeout
+		self.on_release = None
+
+		self.__h2 = h2.connection.H2Connection(
+			config=h2.config.H2Configuration(client_side=True, header_encoding=None))
+		self.__cond = threading.Condition()
+		self.__streams = {}
+		self.__reserved = 0
+		self.__settings_received = False
+		self.__goaway = False
+		self.__error = None
+
+		with self.__cond:
+			self.__h2.initiate_connection()
+			# Only stream windows hold back server, unread body of one stream must not stall others
+			window = self.__h2.local_settings.initial_window_size
+			self.__h2.increment_flow_control_window(min(max_streams * window, _MAX_WINDOW) - window)
+			self.__flush()
+
+		self.__reader = threading.Thread(target=self.__read_loop)
+		self.__reader.daemon = True
+		self.__reader.start()
+
+		# Server limits are unknown until its SETTINGS frame arrives
+		with self.__cond:
+			self.__wait(lambda: self.__settings_received or self.__error, conn_timeout)
+			self.__check()
+
+	def ok(self):
+		return self.__error is None
+
+	def reserve(self):
+		"""Take stream slot if connection has one free"""
+
+		with self.__cond:
+			if self.__error is not None or self.__goaway:
+				return False
+			limit = min(self.max_streams, self.__h2.remote_settings.max_concurrent_streams)
+			if self.__reserved >= limit:
+				return False
+			self.__reserved += 1
+			return True
+
+	def release(self):
+		"""Return stream slot which was not used for request"""
+
+		with self.__cond:
+			self.__reserved -= 1
+		self.__released()
+
+	def close(self):
+		with self.__cond:
+			if self.__error is None:
+				try:
+					self.__h2.close_connection()
+					self.__flush()
+				except (socket.error, h2.exceptions.ProtocolError):
+					pass
+		self.__fail(socket.error("HTTP/2 connection closed."))
+		# Reader must not outlive connection
+		if self.__reader is not threading.current_thread():
+			self.__reader.join()
+
+	def request(self, method, url, body=None, headers={}, trace=None):
+		"""Send request on reserved stream slot and wait for response headers"""
+
+		# Retried request must not send only rest of partly sent body
+		if isinstance(body, _RewindableBody) and not body.rewind():
+			raise IOError("Request body can not be sent again.")
+
+		stream = _HTTP2Stream()
+		failed = None
+		try:
+			with self.__cond:
+				self.__check()
+				stream.id = self.__h2.get_next_available_stream_id()
+				self.__streams[stream.id] = stream
+				try:
+					self.__h2.send_headers(
+						stream.id, self.__request_headers(method, url, headers), end_stream=not body)
+				except h2.exceptions.TooManyStreamsError:
+					# Server lowered its limit, nothing was encoded
+					raise
+				except h2.exceptions.ProtocolError as e:
+					# Header block was rejected after HPACK state changed, connection is unusable
+					failed = socket.error("HTTP/2 connection failed: {0}".format(e))
+					raise
+				self.__flush()
+
+			if body:
+				self.__send_body(stream, body)
+			if trace is not None:
+				trace.mark("send")
+
+			with self.__cond:
+				self.__wait(lambda: stream.status is not None or stream.error or self.__error)
+				if stream.status is None:
+					raise stream.error or self.__error
+		except h2.exceptions.ProtocolError as e:
+			if failed is not None:
+				self.__fail(failed)
+			self._cancel(stream)
+			raise httplib.HTTPException(e)
+		except socket.timeout:
+			self._cancel(stream)
+			raise
+		except socket.error as e:
+			# Write to shared socket failed, retry must not land on this connection
+			self.__fail(e)
+			self._cancel(stream)
+			raise
+		except:
+			self._cancel(stream)
+			raise
+
+		if trace is not None:
+			trace.mark("first_byte")
+		return HTTP2Response(self, stream)
+
+	def _read(self, stream, amt=None):
+		"""Read response body of stream"""
+
+		parts = []
+		size = 0
+		with self.__cond:
+			while True:
+				wanted = None if amt is None else amt - size
+				if stream.data and (wanted is None or wanted > 0):
+					data = "".join(stream.data)
+					if wanted is not None and wanted < len(data):
+						stream.data, stream.buffered = [data[wanted:]], len(data) - wanted
+						data = data[:wanted]
+					else:
+						stream.data, stream.buffered = [], 0
+					parts.append(data)
+					size += len(data)
+					# Server may send more only as fast as body is consumed
+					self.__acknowledge(stream, len(data))
+
+				if stream.ended or (amt is not None and size >= amt):
+					return "".join(parts)
+				self.__check(stream)
+				self.__wait(lambda: stream.data or stream.ended or stream.error or self.__error)
+
+	def _cancel(self, stream):
+		"""Reset stream unless it has ended and free its slot"""
+
+		with self.__cond:
+			if not stream.ended and stream.id is not None and stream.error is None and self.__error is None:
+				try:
+					self.__h2.reset_stream(stream.id, h2.errors.ErrorCodes.CANCEL)
+					self.__flush()
+				except (socket.error, h2.exceptions.ProtocolError):
+					pass
+			self.__acknowledge(stream, stream.buffered)
+			stream.data, stream.buffered = [], 0
+			released = self.__finish(stream)
+		if released:
+			self.__released()
+
+	def __request_headers(self, method, url, headers):
+		result = [
+			(":method", method), (":scheme", self.scheme),
+			(":authority", self.authority), (":path", url) ]
+		for name, value in headers.iteritems():
+			name = name.lower()
+			if name not in _CONNECTION_HEADERS:
+				result.append((name, str(value)))
+		return result
+
+	def __send_body(self, stream, body):
+		if hasattr(body, "read"):
+			chunks = iter(lambda: body.read(_BLOCK_SIZE), "")
+		else:
+			chunks = [body]
+
+		for chunk in chunks:
+			while chunk:
+				with self.__cond:
+					self.__wait(lambda: (
+						stream.error or self.__error or
+						self.__h2.local_flow_control_window(stream.id) > 0))
+					self.__check(stream)
+					size = min(
+						len(chunk), self.__h2.max_outbound_frame_size,
+						self.__h2.local_flow_control_window(stream.id))
+					self.__h2.send_data(stream.id, chunk[:size])
+					self.__flush()
+				chunk = chunk[size:]
+
+		with self.__cond:
+			self.__check(stream)
+			self.__h2.end_stream(stream.id)
+			self.__flush()
+
+	def __wait(self, predicate, timeout=-1):
+		"""Wait on condition until predicate holds, raises socket.timeout"""
+
+		if timeout == -1:
+			timeout = self.net_timeout
+		if timeout is None:
+			while not predicate():
+				self.__cond.wait()
+			return
+
+		deadline = time.time() + timeout
+		while not predicate():
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				raise socket.timeout("timed out")
+			self.__cond.wait(remaining)
+
+	def __check(self, stream=None):
+		if self.__error is not None:
+			raise self.__error
+		if stream is not None and stream.error is not None:
+			raise stream.error
+
+	def __flush(self):
+		data = self.__h2.data_to_send()
+		if data:
+			self.sock.sendall(data)
+
+	def __finish(self, stream):
+		"""Free stream slot, returns 1 if slot was freed"""
+
+		if stream.finished:
+			return 0
+		stream.finished = True
+		self.__streams.pop(stream.id, None)
+		self.__reserved -= 1
+		return 1
+
+	def __acknowledge(self, stream, size):
+		# Data of ended stream was acknowledged when it ended
+		if size and not stream.ended and self.__error is None:
+			try:
+				self.__h2.acknowledge_received_data(size, stream.id)
+				self.__flush()
+			except (socket.error, h2.exceptions.ProtocolError):
+				pass
+
+	def __released(self):
+		if self.on_release is not None:
+			self.on_release()
+
+	def __receive(self, data):
+		"""Process incoming frames, returns number of freed stream slots"""
+
+		released = 0
+		for event in self.__h2.receive_data(data):
+			stream = self.__streams.get(getattr(event, "stream_id", None))
+
+			if isinstance(event, h2.events.RemoteSettingsChanged):
+				self.__settings_received = True
+			elif isinstance(event, h2.events.ResponseReceived) and stream:
+				stream.status = int(dict(event.headers)[":status"])
+				stream.headers = [ (k, v) for k, v in event.headers if not k.startswith(":") ]
+			elif isinstance(event, h2.events.DataReceived):
+				# Buffered data is acknowledged when read, padding and orphans now
+				unread = 0
+				if stream:
+					stream.data.append(event.data)
+					stream.buffered += len(event.data)
+					unread = len(event.data)
+				if event.flow_controlled_length > unread:
+					self.__h2.acknowledge_received_data(
+						event.flow_controlled_length - unread, event.stream_id)
+			elif isinstance(event, h2.events.StreamEnded) and stream:
+				# Ended stream no longer needs flow control, its unread data must not keep connection window
+				self.__acknowledge(stream, stream.buffered)
+				stream.ended = True
+				released += self.__finish(stream)
+			elif isinstance(event, h2.events.StreamReset) and stream:
+				stream.error = HTTP2StreamError(event.error_code)
+				released += self.__finish(stream)
+			elif isinstance(event, h2.events.PushedStreamReceived):
+				self.__h2.reset_stream(event.pushed_stream_id, h2.errors.ErrorCodes.REFUSED_STREAM)
+			elif isinstance(event, h2.events.ConnectionTerminated):
+				# Streams above last_stream_id were never processed by server
+				self.__goaway = True
+				last_stream_id = event.last_stream_id or 0
+				for stream in self.__streams.values():
+					if stream.id > last_stream_id:
+						stream.error = HTTP2StreamError(event.error_code)
+						released += self.__finish(stream)
+
+		self.__flush()
+		self.__cond.notify_all()
+		return released
+
+	def __read_loop(self):
+		error = None
+		try:
+			while True:
+				select.select([self.sock], [], [])
+				with self.__cond:
+					data = self.sock.recv(_BLOCK_SIZE)
+					if not data:
+						break
+					released = self.__receive(data)
+				for _ in xrange(released):
+					self.__released()
+		except (socket.error, select.error, h2.exceptions.ProtocolError) as e:
+			error = socket.error("HTTP/2 connection failed: {0}".format(e))
+		self.__fail(error or socket.error("HTTP/2 connection closed by server."))
+
+	def __fail(self, error):
+		"""Mark connection as broken and fail all pending streams"""
+
+		released = 0
+		with self.__cond:
+			if self.__error is None:
+				self.__error = error
+			for stream in self.__streams.values():
+				if stream.error is None:
+					stream.error = self.__error
+				released += self.__finish(stream)
+			self.__cond.notify_all()
+		try:
+			# Shutdown wakes reader up, closing alone does not
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		try:
+			self.sock.close()
+		except socket.error:
+			pass
+		if released:
+			self.__released()
+
+
+class _HTTP2Slot(ConnectionWrapper):
+	"""Stream slot reserved on shared HTTP/2 connection"""
+
+	def __init__(self, conn):
+		ConnectionWrapper.__init__(self, conn)
+		self.used = False
+
+	def ok(self):
+		return self.conn.ok()
+
+	def close(self):
+		# Failed stream is reset on its own, shared connection is dropped only if it failed too
+		if not self.conn.ok():
+			self.conn.close()
+
+	def request(self, *args, **kwargs):
+		self.used = True
+		return self.conn.request(*args, **kwargs)
+
+
+def _create_http2_connection(
+	host, port=None, ssl_context=None, conn_timeout=None, net_timeout=None, max_streams=100):
+	"""Create new connection, h2 over TLS if ssl_context is given, h2c otherwise"""
+
+	_require_h2()
+
+	scheme, default_port = ("https", 443) if ssl_context else ("http", 80)
+	port = port or default_port
+	authority = host if port == default_port else "{0}:{1}".format(host, port)
+
+	sock = socket.create_connection((host, port), conn_timeout)
+	try:
+		if ssl_context is not None:
+			sock = ssl_context.wrap_socket(sock, server_hostname=host)
+			if sock.selected_alpn_protocol() != "h2":
+				raise httplib.HTTPException("Server did not negotiate HTTP/2.")
+		sock.settimeout(None)
+		return _HTTP2Connection(
+			sock, authority, scheme=scheme, max_streams=max_streams,
+			conn_timeout=conn_timeout, net_timeout=net_timeout)
+	except:
+		sock.close()
+		raise
+
+
+class HTTP2SingleHostConnectionPool(HTTPSingleHostConnectionPool):
+	"""Hands out stream slots on up to pool_size multiplexed connections"""
+
+	# Request data goes through h2 framing and flow control
+	STREAM_UPLOADS = False
+
+	def __init__(self, connection_factory,
+		pool_size=1, pool_block=False, pool_timeout=None, tracer=None, hooks=None):
+
+		# Multiplexed connections are shared by streams, never checked in or out
+		if hooks is not None:
+			raise ValueError("Lifecycle hooks are not supported by HTTP/2 pool")
+
+		HTTPSingleHostConnectionPool.__init__(
+			self, connection_factory,
+			pool_size=pool_size, pool_block=pool_block, pool_timeout=pool_timeout,
+			tracer=tracer)
+
+		self.__connection_factory = connection_factory
+		self.__pool_size = pool_size
+		self.__pool_block = pool_block
+		self.__pool_timeout = pool_timeout
+
+		self.__cond = threading.Condition()
+		self.__connections = []
+		self.__connecting = 0
+		self.__closed = False
+
+	def request(self, method, url, body=None, headers={}):
+		if hasattr(body, "read"):
+			body = _RewindableBody(body)
+		return HTTPSingleHostConnectionPool.request(self, method, url, body=body, headers=headers)
+
+	def get_connection_count(self):
+		"""Return number of open connections"""
+
+		with self.__cond:
+			return len(self.__connections)
+
+	def __notify(self):
+		with self.__cond:
+			self.__cond.notify_all()
+
+	def _get_conn(self, trace=None):
+		"""Reserve stream slot on existing connection or open a new one"""
+
+		deadline = None
+		if self.__pool_block and self.__pool_timeout is not None:
+			deadline = time.time() + self.__pool_timeout
+
+		broken = []
+		try:
+			with self.__cond:
+				while True:
+					if self.__closed:
+						raise PoolIsClosedError()
+
+					for conn in [ c for c in self.__connections if not c.ok() ]:
+						self.__connections.remove(conn)
+						broken.append(conn)
+
+					# Fill up oldest connections first to keep socket count low
+					for conn in self.__connections:
+						if conn.reserve():
+							if trace is not None:
+								trace.mark("pool_wait")
+								trace.checkout(conn, False)
+							return _HTTP2Slot(conn)
+
+					# Connection being opened will likely have free slots, wait for it
+					if self.__connecting:
+						self.__cond.wait()
+						continue
+
+					if len(self.__connections) < self.__pool_size:
+						self.__connecting += 1
+						break
+
+					if not self.__pool_block:
+						raise PoolIsEmptyError()
+					if deadline is None:
+						self.__cond.wait()
+					else:
+						remaining = deadline - time.time()
+						if remaining <= 0:
+							raise PoolIsEmptyError()
+						self.__cond.wait(remaining)
+		finally:
+			# Closing waits for reader thread, which may need pool condition
+			for conn in broken:
+				conn.close()
+
+		if trace is not None:
+			trace.mark("pool_wait")
+		try:
+			conn = self.__connection_factory()
+		except:
+			with self.__cond:
+				self.__connecting -= 1
+				self.__cond.notify_all()
+			raise
+
+		conn.on_release = self.__notify
+		with self.__cond:
+			self.__connecting -= 1
+			if self.__closed:
+				conn.close()
+				raise PoolIsClosedError()
+			self.__connections.append(conn)
+			conn.reserve()
+			self.__cond.notify_all()
+
+		if trace is not None:
+			trace.checkout(conn, True)
+		return _HTTP2Slot(conn)
+
+	def _put_conn(self, conn):
+		"""Return unused stream slot, used ones are freed when stream ends"""
+
+		if conn and not conn.used:
+			conn.conn.release()
+
+	def close(self):
+		"""Close connection pool"""
+
+		with self.__cond:
+			if self.__closed:
+				return
+			self.__closed = True
+			connections, self.__connections = self.__connections, []
+			self.__cond.notify_all()
+
+		for conn in connections:
+			conn.close()
+		HTTPSingleHostConnectionPool.close(self)
+
+
+class HTTP2ConnectionPool(HTTPConnectionPool):
+
+	SingleHostPoolCls = HTTP2SingleHostConnectionPool
+
+	def __init__(
+		self, ssl_context=None, conn_timeout=None, net_timeout=None, max_streams=100,
+		cache_size=100, pool_size=10, pool_block=False, pool_timeout=None, tracer=None,
+		response_cache=None, coalesce=False, coalesce_headers=()):
+
+		_require_h2()
+		if ssl_context is not None:
+			ssl_context.set_alpn_protocols(["h2"])
+
+		ConnectionPool.__init__(
+			self,
+			lambda host, port: _create_http2_connection(
+				host, port, ssl_context, conn_timeout, net_timeout, max_streams),
+			cache_size=cache_size,
+			pool_size=pool_size, pool_block=pool_block, pool_timeout=pool_timeout,
+			tracer=tracer)
+		self._init_layers(response_cache, coalesce, coalesce_headers)
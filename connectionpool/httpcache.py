@@ -0,0 +1,329 @@
+# In-memory HTTP response cache honoring Cache-Control/Expires and
+# revalidating stale entries with ETag/Last-Modified.
+#
+# This module is part of python-connectionpool and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php
+
+
+import email.utils
+import threading
+import time
+
+from .lrucache import LRUCache
+
+
+_CACHEABLE_STATUSES = frozenset([200, 203, 300, 301, 404, 410])
+_UNSAFE_METHODS = frozenset(["POST", "PUT", "DELETE", "PATCH"])
+_CONDITIONAL_HEADERS = frozenset(["if-none-match", "if-modified-since", "if-match", "if-unmodified-since", "range"])
+# Headers of 304 response describing its own (empty) body
+_BODY_HEADERS = frozenset(["content-length", "transfer-encoding", "content-encoding"])
+
+# Response directives allowing to store answer to request with Authorization
+_SHARED_AUTH_DIRECTIVES = frozenset(["public", "s-maxage", "must-revalidate"])
+
+# Rough per entry overhead accounted on top of body and headers
+_ENTRY_OVERHEAD = 256
+
+
+def _parse_date(value):
+	if not value:
+		return None
+	parsed = email.utils.parsedate_tz(value)
+	if parsed is None:
+		return None
+	return email.utils.mktime_tz(parsed)
+
+
+def _parse_cache_control(value):
+	"""Return dict of Cache-Control directives, valueless ones map to None"""
+
+	directives = {}
+	for directive in (value or "").split(","):
+		name, _, argument = directive.strip().partition("=")
+		if name:
+			directives[name.lower()] = argument.strip().strip('"') or None
+	return directives
+
+
+def _parse_int(value):
+	try:
+		return max(0, int(value))
+	except (TypeError, ValueError):
+		return None
+
+
+class CachedResponse:
+	"""Fully read response served from cache, mimics httplib.HTTPResponse"""
+
+	def __init__(self, entry):
+		self.status = entry.status
+		self.reason = entry.reason
+		self.version = entry.version
+		self.__headers = entry.headers
+		self.__body = entry.body
+		self.__offset = 0
+
+	def getheader(self, name, default=None):
+		name = name.lower()
+		values = [ v for k, v in self.__headers if k == name ]
+		return ", ".join(values) if values else default
+
+	def getheaders(self):
+		return list(self.__headers)
+
+	def read(self, amt=None):
+		start = self.__offset
+		end = len(self.__body) if amt is None else min(len(self.__body), start + amt)
+		self.__offset = end
+		return self.__body[start:end]
+
+	def isclosed(self):
+		return self.__offset >= len(self.__body)
+
+	def close(self):
+		self.__offset = len(self.__body)
+
+
+class _PartlyReadResponse:
+	"""Response whose body was partly read already, serves that part first"""
+
+	def __init__(self, response, head):
+		self.__response = response
+		self.__head = head
+
+	def __getattr__(self, name):
+		return getattr(self.__response, name)
+
+	def read(self, amt=None):
+		head = self.__head
+		if amt is None:
+			self.__head = ""
+			return head + self.__response.read()
+		if head:
+			self.__head = head[amt:]
+			return head[:amt]
+		return self.__response.read(amt)
+
+	def isclosed(self):
+		return not self.__head and self.__response.isclosed()
+
+
+class _CacheEntry:
+
+	def __init__(self, response, vary):
+		self.status = response.status
+		self.reason = response.reason
+		self.version = response.version
+		self.headers = [ (k.lower(), v) for k, v in response.getheaders() ]
+		self.body = ""
+		self.vary = vary
+		self.expires = 0.0
+		self.resize()
+
+	def resize(self):
+		self.size = len(self.body) + sum(len(k) + len(v) for k, v in self.headers) + _ENTRY_OVERHEAD
+
+	def getheader(self, name):
+		for k, v in self.headers:
+			if k == name:
+				return v
+		return None
+
+	def update(self, response):
+		"""Merge headers of 304 response into entry"""
+
+		updated = dict(
+			(k.lower(), v) for k, v in response.getheaders() if k.lower() not in _BODY_HEADERS)
+		self.headers = [ (k, v) for k, v in self.headers if k not in updated ] + updated.items()
+		self.resize()
+
+	def refresh(self, now):
+		"""Compute expiry time from response headers, returns False if entry must not be stored"""
+
+		cache_control = _parse_cache_control(self.getheader("cache-control"))
+		if "no-store" in cache_control:
+			return False
+
+		date = _parse_date(self.getheader("date")) or now
+		age = _parse_int(self.getheader("age")) or 0
+		last_modified = _parse_date(self.getheader("last-modified"))
+
+		if "no-cache" in cache_control:
+			lifetime = 0
+		elif _parse_int(cache_control.get("s-maxage")) is not None:
+			# Cache is shared between all callers of pool
+			lifetime = _parse_int(cache_control.get("s-maxage"))
+		elif _parse_int(cache_control.get("max-age")) is not None:
+			lifetime = _parse_int(cache_control.get("max-age"))
+		elif self.getheader("expires") is not None:
+			lifetime = (_parse_date(self.getheader("expires")) or date) - date
+		elif last_modified is not None:
+			# Heuristic freshness, 10% of time since last modification
+			lifetime = (date - last_modified) / 10
+		else:
+			lifetime = 0
+
+		self.expires = now + lifetime - age
+		return self.expires > now or self.validators()
+
+	def validators(self):
+		"""Return conditional request headers able to revalidate entry"""
+
+		headers = {}
+		if self.getheader("etag") is not None:
+			headers["If-None-Match"] = self.getheader("etag")
+		if self.getheader("last-modified") is not None:
+			headers["If-Modified-Since"] = self.getheader("last-modified")
+		return headers
+
+
+def read_response(response):
+	"""Read response fully into snapshot which CachedResponse can serve repeatedly"""
+
+	entry = _CacheEntry(response, [])
+	entry.body = response.read()
+	entry.resize()
+	return entry
+
+
+class HTTPResponseCache:
+	"""Response cache for GET requests bounded by total size in bytes"""
+
+	def __init__(self, max_bytes=64 * 1024 * 1024, max_entry_bytes=None):
+		self.__max_entry_bytes = max_entry_bytes or max_bytes // 8
+		self.__entries = LRUCache(cache_size=max_bytes, sizefunc=lambda e: e.size)
+		self.__lock = threading.Lock()
+		self.__hits = 0
+		self.__misses = 0
+		self.__revalidations = 0
+		self.__bytes_saved = 0
+
+	def get_stats(self):
+		"""Return hit/miss/revalidation counters, bytes saved and bytes used"""
+
+		with self.__lock:
+			return {
+				"hits": self.__hits,
+				"misses": self.__misses,
+				"revalidations": self.__revalidations,
+				"bytes_saved": self.__bytes_saved,
+				"bytes_used": self.__entries.getcursize(),
+				"entries": len(self.__entries),
+			}
+
+	def clear(self):
+		"""Drop all cached responses"""
+
+		self.__entries.clear()
+
+	def __count(self, hits=0, misses=0, revalidations=0, bytes_saved=0):
+		with self.__lock:
+			self.__hits += hits
+			self.__misses += misses
+			self.__revalidations += revalidations
+			self.__bytes_saved += bytes_saved
+
+	def __invalidate(self, key):
+		try:
+			del self.__entries[key]
+		except KeyError:
+			pass
+
+	def request(self, send, host, port, method, url, body=None, headers={}):
+		"""Serve request from cache or through send(method, url, body, headers)"""
+
+		key = (host, port, url)
+		request_headers = dict((k.lower(), v) for k, v in headers.iteritems())
+
+		if method != "GET" or body or _CONDITIONAL_HEADERS.intersection(request_headers):
+			if method in _UNSAFE_METHODS:
+				self.__invalidate(key)
+			return send(method, url, body, headers)
+
+		cache_control = _parse_cache_control(request_headers.get("cache-control"))
+		if "no-store" in cache_control:
+			return send(method, url, body, headers)
+		revalidate = (
+			"no-cache" in cache_control or cache_control.get("max-age") == "0" or
+			request_headers.get("pragma") == "no-cache")
+
+		entry = self.__entries.get(key)
+		if entry is not None and entry.vary != [ (name, request_headers.get(name)) for name, _ in entry.vary ]:
+			entry = None
+
+		now = time.time()
+		if entry is not None and not revalidate and entry.expires > now:
+			self.__count(hits=1, bytes_saved=len(entry.body))
+			return CachedResponse(entry)
+
+		if entry is not None and entry.validators():
+			conditional_headers = dict(headers)
+			conditional_headers.update(entry.validators())
+			response = send(method, url, body, conditional_headers)
+			if response.status == 304:
+				response.read()
+				entry.update(response)
+				if entry.refresh(time.time()):
+					self.__entries[key] = entry
+				else:
+					self.__invalidate(key)
+				self.__count(revalidations=1, bytes_saved=len(entry.body))
+				return CachedResponse(entry)
+		else:
+			response = send(method, url, body, headers)
+
+		self.__count(misses=1)
+		return self.__store(key, request_headers, response)
+
+	def __store(self, key, request_headers, response):
+		"""Read cacheable response fully and store it, returns response to hand out"""
+
+		if response.status not in _CACHEABLE_STATUSES:
+			return response
+
+		vary = [ v.strip().lower() for v in (response.getheader("vary") or "").split(",") if v.strip() ]
+		if "*" in vary:
+			return response
+		cache_control = _parse_cache_control(response.getheader("cache-control"))
+		if "private" in cache_control:
+			return response
+		if "authorization" in request_headers and not _SHARED_AUTH_DIRECTIVES.intersection(cache_control):
+			return response
+		# Responses tied to cookies are stored only if explicitly shareable
+		if ("cookie" in request_headers or response.getheader("set-cookie") is not None) and \
+			"public" not in cache_control:
+			return response
+		length = _parse_int(response.getheader("content-length"))
+		if length is not None and length > self.__max_entry_bytes:
+			return response
+
+		entry = _CacheEntry(response, [ (name, request_headers.get(name)) for name in vary ])
+		if not entry.refresh(time.time()):
+			return response
+
+		# Body without Content-Length is read only up to entry limit
+		limit = self.__max_entry_bytes - entry.size
+		if limit < 0:
+			return response
+		body = self.__read_limited(response, limit)
+		if len(body) > limit:
+			return _PartlyReadResponse(response, body)
+
+		entry.body = body
+		entry.resize()
+		self.__entries[key] = entry
+		return CachedResponse(entry)
+
+	@staticmethod
+	def __read_limited(response, limit):
+		"""Read body until its end or until it exceeds limit"""
+
+		chunks = []
+		size = 0
+		while size <= limit:
+			data = response.read(limit + 1 - size)
+			if not data:
+				break
+			chunks.append(data)
+			size += len(data)
+		return "".join(chunks)
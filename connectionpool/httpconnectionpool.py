@@ -4,13 +4,25 @@
 
 import httplib
 import socket
+import time
 
 from .connectionpool import (
 	ConnectionPool,
 	ConnectionWrapper,
 	PoolBrokenConnectionError,
+	PoolIsEmptyError,
 	SingleHostConnectionPool,
 )
+from .broker import BrokerClient
+from .httpcache import _CONDITIONAL_HEADERS, CachedResponse, read_response
+from .replicaset import ReplicaSetPool
+from .singleflight import SingleFlight
+from .streaming import _StreamingBody, streaming_body
+from .tracing import TracedResponse
+
+
+# Request headers always taken into account when coalescing requests
+_CREDENTIAL_HEADERS = ("authorization", "proxy-authorization", "cookie")
 
 
 #FIXME: more strong connection status check
@@ -22,35 +34,241 @@ class _HTTPConnectionWrapper(ConnectionWrapper):
 	def close(self):
 		self.conn.close()
 
-	def request(self, *args, **kwargs):
-		self.conn.request(*args, **kwargs)
-		return self.conn.getresponse()
+	def request(self, method, url, body=None, headers={}, trace=None):
+		if isinstance(body, _StreamingBody):
+			self.__send_streaming(method, url, body, headers)
+		else:
+			self.conn.request(method, url, body=body, headers=headers)
+		if trace is None:
+			return self.conn.getresponse()
+
+		trace.mark("send")
+		response = self.conn.getresponse()
+		trace.mark("first_byte")
+		return response
+
+	def __send_streaming(self, method, url, body, headers):
+		"""Send headers through httplib and write body to socket directly"""
+
+		names = set(name.lower() for name in headers)
+		self.conn.putrequest(
+			method, url, skip_host="host" in names, skip_accept_encoding="accept-encoding" in names)
+		for name, value in headers.iteritems():
+			self.conn.putheader(name, value)
+
+		# Explicit Content-Length means body is sent as is
+		chunked = "content-length" not in names and (body.length is None or "transfer-encoding" in names)
+		if chunked and "transfer-encoding" not in names:
+			self.conn.putheader("Transfer-Encoding", "chunked")
+		elif not chunked and "content-length" not in names:
+			self.conn.putheader("Content-Length", str(body.length))
+		self.conn.endheaders()
+
+		body.send(self.conn.sock, chunked)
+
+
+class _BrokeredHTTPConnectionWrapper(_HTTPConnectionWrapper):
+
+	def __init__(self, conn, broker):
+		_HTTPConnectionWrapper.__init__(self, conn)
+		self.broker = broker
+		self.returned = False
+
+	def close(self):
+		# Hand socket back to broker instead of closing upstream connection
+		if not self.returned:
+			self.returned = True
+			sock, self.conn.sock = self.conn.sock, None
+			if sock is None:
+				self.broker.discard(self.conn.host, self.conn.port)
+			else:
+				self.broker.release(self.conn.host, self.conn.port, sock)
+		self.conn.close()
+
+
+def _resolve(host, port):
+	return socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+
+def _connect(host, port, timeout=None, resolve=_resolve):
+	"""Resolve host and connect to first reachable address, returns socket and resolve timestamp"""
+
+	addresses = resolve(host, port)
+	resolved = time.time()
+
+	error = socket.error("getaddrinfo returns an empty list")
+	for family, socktype, proto, _, address in addresses:
+		sock = None
+		try:
+			sock = socket.socket(family, socktype, proto)
+			sock.settimeout(timeout)
+			sock.connect(address)
+			return sock, resolved
+		except socket.error as e:
+			error = e
+			if sock is not None:
+				sock.close()
+	raise error
 
 
-def _create_connection(host, port=None, strict=False, conn_timeout=None, net_timeout=None):
+def _create_connection(host, port=None, strict=False, conn_timeout=None, net_timeout=None, resolve=_resolve):
 	"""Create new connection"""
 
 	conn = httplib.HTTPConnection(host=host, port=port, strict=strict, timeout=conn_timeout)
-	conn.connect()
+	conn.sock, resolved = _connect(conn.host, conn.port, conn_timeout, resolve)
+	connected = time.time()
+	conn.timeout = net_timeout
+	conn.sock.settimeout(conn.timeout)
+
+	wrapper = _HTTPConnectionWrapper(conn)
+	wrapper.timings = [("dns", resolved), ("connect", connected)]
+	return wrapper
+
+
+def _create_brokered_connection(
+	broker, host, port=None, strict=False, conn_timeout=None, net_timeout=None, resolve=_resolve):
+	"""Borrow connection from pool broker, create new one if broker is unavailable or exhausted"""
+
+	conn = httplib.HTTPConnection(host=host, port=port, strict=strict, timeout=conn_timeout)
+	try:
+		sock = broker.acquire(conn.host, conn.port)
+	except PoolIsEmptyError:
+		sock = None
+	if sock is None:
+		return _create_connection(host, port, strict, conn_timeout, net_timeout, resolve)
+
+	conn.sock = sock
 	conn.timeout = net_timeout
 	conn.sock.settimeout(conn.timeout)
 
-	return _HTTPConnectionWrapper(conn)
+	return _BrokeredHTTPConnectionWrapper(conn, broker)
 
 
-def _send_request(conn, method, url, body=None, headers={}):
+def _send_request(conn, method, url, body=None, headers={}, trace=None):
 		try:
-			return conn.request(method, url, body=body, headers=headers)
+			if trace is None:
+				return conn.request(method, url, body=body, headers=headers)
+			return conn.request(method, url, body=body, headers=headers, trace=trace)
 		except socket.timeout as e:
 			raise e
 		except (httplib.HTTPException, socket.error) as e:
 			raise PoolBrokenConnectionError(e)
 
 
+class _ReleasingResponse:
+	"""Response proxy returning connection to pool when body is read or response closed"""
+
+	def __init__(self, response, release):
+		self.__response = response
+		self.__release = release
+		# Nothing to read after bodyless response
+		if getattr(response, "length", None) == 0:
+			self.__done()
+
+	def __getattr__(self, name):
+		return getattr(self.__response, name)
+
+	def read(self, amt=None):
+		try:
+			data = self.__response.read(amt)
+		except Exception:
+			self.__done(broken=True)
+			raise
+		if amt is None or not data or self.__response.isclosed():
+			self.__done()
+		return data
+
+	def close(self):
+		self.__response.close()
+		self.__done()
+
+	def __done(self, broken=False):
+		release, self.__release = self.__release, None
+		if release is not None:
+			release(broken)
+
+
 class HTTPSingleHostConnectionPool(SingleHostConnectionPool):
+
+	# Send file, buffer and iterable bodies directly to socket
+	STREAM_UPLOADS = True
+	# Keep every connection checked out until its response is consumed,
+	# streamed uploads always do
+	HOLD_UNTIL_READ = False
+
 	def request(self, method, url, body=None, headers={}):
-		return SingleHostConnectionPool.request(
-			self, lambda conn: _send_request(conn, method, url, body=body, headers=headers))
+		tracer = self.get_tracer()
+		trace = None if tracer is None else tracer.start(
+			"HTTP {0}".format(method), **{"http.method": method, "http.url": url})
+
+		stream = streaming_body(body) if self.STREAM_UPLOADS else None
+		held = stream is not None or self.HOLD_UNTIL_READ
+		if stream is not None:
+			body = stream
+		if trace is None:
+			if held:
+				return self.__request_held(method, url, body, headers)
+			return self._request(lambda conn: _send_request(conn, method, url, body=body, headers=headers))
+
+		try:
+			if held:
+				response = self.__request_held(method, url, body, headers, trace)
+			else:
+				response = self._request(
+					lambda conn: _send_request(conn, method, url, body=body, headers=headers, trace=trace),
+					trace)
+		except Exception as e:
+			tracer.fail(trace, e)
+			raise
+		return TracedResponse(response, trace, tracer)
+
+	def __request_held(self, method, url, body, headers, trace=None):
+		"""Send request, connection stays checked out until response is consumed"""
+
+		retries = 2
+		while True:
+			retries -= 1
+			conn = self._get_conn() if trace is None else self._get_conn(trace)
+			try:
+				response = _send_request(conn, method, url, body=body, headers=headers, trace=trace)
+			except PoolBrokenConnectionError as e:
+				self.__release(conn, broken=True)
+				# Partially consumed iterables can not be sent again
+				if retries == 0 or (isinstance(body, _StreamingBody) and not body.rewind()):
+					raise e.expt
+				if trace is not None:
+					trace.retries += 1
+				continue
+			except:
+				# Connection is in unknown state after interrupted upload
+				self.__release(conn, broken=True)
+				raise
+			return _ReleasingResponse(response, lambda broken: self.__release(conn, broken))
+
+	def __release(self, conn, broken=False):
+		if broken:
+			self._discard(conn)
+			conn = None
+		self._put_conn(conn)
+
+
+class _BrokeredHTTPSingleHostConnectionPool(HTTPSingleHostConnectionPool):
+	"""Keeps borrowed sockets only while their request is in flight"""
+
+	HOLD_UNTIL_READ = True
+
+	def _put_conn(self, conn):
+		# Idle sockets go back to broker so other workers can use them
+		if isinstance(conn, _BrokeredHTTPConnectionWrapper):
+			conn.close()
+			conn = None
+		HTTPSingleHostConnectionPool._put_conn(self, conn)
+
+	def _discard(self, conn):
+		if isinstance(conn, _BrokeredHTTPConnectionWrapper):
+			# Socket in unknown state must not be lent again
+			conn.conn.close()
+		HTTPSingleHostConnectionPool._discard(self, conn)
 
 
 class HTTPConnectionPool(ConnectionPool):
@@ -59,14 +277,87 @@ class HTTPConnectionPool(ConnectionPool):
 
 	def __init__(
 		self, strict=False, conn_timeout=None, net_timeout=None,
-		cache_size=100, pool_size=100, pool_block=False, pool_timeout=None):
+		cache_size=100, pool_size=100, pool_block=False, pool_timeout=None,
+		broker_path=None, tracer=None, response_cache=None,
+		coalesce=False, coalesce_headers=(), hooks=None):
+
+		self._init_layers(response_cache, coalesce, coalesce_headers)
+
+		# Coalesced pools also share host resolution between concurrent connects
+		resolve = _resolve if not coalesce else lambda host, port: self.__in_flight.do(
+			("getaddrinfo", host, port), lambda: _resolve(host, port))
+
+		if broker_path is None:
+			connection_factory = lambda host, port: _create_connection(
+				host, port, strict, conn_timeout, net_timeout, resolve)
+		else:
+			self.SingleHostPoolCls = _BrokeredHTTPSingleHostConnectionPool
+			broker = BrokerClient(broker_path, timeout=conn_timeout)
+			connection_factory = lambda host, port: _create_brokered_connection(
+				broker, host, port, strict, conn_timeout, net_timeout, resolve)
 
 		ConnectionPool.__init__(
 			self,
-			lambda host, port: _create_connection(host, port, strict, conn_timeout, net_timeout),
+			connection_factory,
 			cache_size=cache_size,
-			pool_size=pool_size, pool_block=pool_block, pool_timeout=pool_timeout)
+			pool_size=pool_size, pool_block=pool_block, pool_timeout=pool_timeout,
+			tracer=tracer, hooks=hooks)
+
+	def _init_layers(self, response_cache=None, coalesce=False, coalesce_headers=()):
+		"""Set up optional response cache and request coalescing"""
+
+		self.__response_cache = response_cache
+		self.__in_flight = SingleFlight() if coalesce else None
+		self.__coalesce_headers = [ name.lower() for name in coalesce_headers ]
+		# Never share one caller's response with another caller's credentials
+		self.__coalesce_headers.extend(
+			name for name in _CREDENTIAL_HEADERS if name not in self.__coalesce_headers)
+
+	def get_response_cache(self):
+		"""Return response cache or None if caching is disabled"""
+
+		return self.__response_cache
 
 	def request(self, host, port, method, url, body=None, headers={}):
-		return self.get(host, port).request(method, url, body=body, headers=headers)
+		if self.__in_flight is not None and method == "GET" and not body:
+			request_headers = dict((k.lower(), v) for k, v in headers.iteritems())
+			# Conditional and range requests get answers which only fit themselves
+			if not _CONDITIONAL_HEADERS.intersection(request_headers):
+				# Identical concurrent GETs wait for one upstream request and share its body
+				key = (host, port, method, url, tuple(request_headers.get(name) for name in self.__coalesce_headers))
+				return CachedResponse(self.__in_flight.do(
+					key, lambda: read_response(self.__request(host, port, method, url, body, headers))))
+
+		return self.__request(host, port, method, url, body, headers)
+
+	def __request(self, host, port, method, url, body, headers):
+		if self.__response_cache is None:
+			return self.get(host, port).request(method, url, body=body, headers=headers)
+
+		# Cache hits never touch the pool
+		return self.__response_cache.request(
+			lambda method, url, body, headers: self.get(host, port).request(
+				method, url, body=body, headers=headers),
+			host, port, method, url, body=body, headers=headers)
+
+
+class HTTPReplicaSetPool(ReplicaSetPool):
 
+	SingleHostPoolCls = HTTPSingleHostConnectionPool
+
+	def __init__(
+		self, replicas, strict=False, conn_timeout=None, net_timeout=None,
+		balancer=ReplicaSetPool.TWO_CHOICES, latency_decay=0.3, latency_half_life=10.0, fail_timeout=10.0,
+		pool_size=100, pool_block=False, pool_timeout=None, tracer=None, hooks=None):
+
+		ReplicaSetPool.__init__(
+			self,
+			lambda host, port: _create_connection(host, port, strict, conn_timeout, net_timeout),
+			replicas,
+			balancer=balancer, latency_decay=latency_decay, latency_half_life=latency_half_life,
+			fail_timeout=fail_timeout,
+			pool_size=pool_size, pool_block=pool_block, pool_timeout=pool_timeout,
+			tracer=tracer, hooks=hooks)
+
+	def request(self, method, url, body=None, headers={}):
+		return self._balance(lambda pool: pool.request(method, url, body=body, headers=headers))
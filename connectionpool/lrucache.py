@@ -9,17 +9,23 @@ import collections
 import threading
 
 class LRUCache(collections.MutableMapping):
-	"""Simple LRU Cache with dict like interface"""
+	"""Simple LRU Cache with dict like interface
 
-	def __init__(self, cache_size=1000, disposefunc=None):
-		PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+	By default cache_size limits number of entries; with sizefunc it
+	limits total sizefunc(value) of all entries instead.
+	"""
+
+	def __init__(self, cache_size=1000, disposefunc=None, sizefunc=None):
+		PREV, NEXT, KEY, VALUE, SIZE = 0, 1, 2, 3, 4
 
 		self.__cache_size = cache_size
 		self.__cache = {}
 		self.__disposefunc = disposefunc
+		self.__sizefunc = sizefunc
+		self.__cur_size = 0
 
-		self.__head = [ None, None, None, None ]        # oldest
-		self.__tail = [ self.__head, None, None, None ]   # newest
+		self.__head = [ None, None, None, None, 0 ]        # oldest
+		self.__tail = [ self.__head, None, None, None, 0 ]   # newest
 		self.__head[NEXT] = self.__tail
 
 		self.__lock = threading.Lock()
@@ -27,12 +33,13 @@ class LRUCache(collections.MutableMapping):
 	def __contains__(self, key):
 		return (key in self.__cache)
 
-	def __delitem__(self, key, PREV=0, NEXT=1, KEY=2, VALUE=3):
+	def __delitem__(self, key, PREV=0, NEXT=1, KEY=2, VALUE=3, SIZE=4):
 		with self.__lock:
 			oldlink = self.__cache.pop(key)
-			oldlink_prev, oldlink_next, oldkey, oldvalue = oldlink
+			oldlink_prev, oldlink_next, oldkey, oldvalue, oldsize = oldlink
 			oldlink_prev[NEXT] = oldlink_next
 			oldlink_next[PREV] = oldlink_prev
+			self.__cur_size -= oldsize
 		if self.__disposefunc:
 			self.__disposefunc(oldvalue)
 
@@ -41,7 +48,7 @@ class LRUCache(collections.MutableMapping):
 
 		with self.__lock:
 			link = cache[key]
-			link_prev, link_next, key, value = link
+			link_prev, link_next = link[PREV], link[NEXT]
 			link_prev[NEXT] = link_next
 			link_next[PREV] = link_prev
 			last = tail[PREV]
@@ -58,30 +65,37 @@ class LRUCache(collections.MutableMapping):
 		with self.__lock:
 			return len(self.__cache)
 
-	def __setitem__(self, key, value, PREV=0, NEXT=1, KEY=2, VALUE=3, sentinel=object()):
+	def __setitem__(self, key, value, PREV=0, NEXT=1, KEY=2, VALUE=3, SIZE=4, sentinel=object()):
 		cache, head, tail = self.__cache, self.__head, self.__tail
+		size = self.__sizefunc(value) if self.__sizefunc else 1
 
-		oldlink = sentinel
+		oldvalues = []
 		with self.__lock:
-			oldlink = cache.get(key, sentinel)
+			oldlink = cache.pop(key, sentinel)
 			if oldlink is not sentinel:
-				oldlink_prev, oldlink_next, oldkey, oldvalue = oldlink
+				oldlink_prev, oldlink_next, oldkey, oldvalue, oldsize = oldlink
 				oldlink_prev[NEXT] = oldlink_next
 				oldlink_next[PREV] = oldlink_prev
+				self.__cur_size -= oldsize
+				oldvalues.append(oldvalue)
 
-			if len(cache) >= self.__cache_size:
+			while self.__cur_size + size > self.__cache_size and head[NEXT] is not tail:
 				oldlink = head[NEXT]
-				oldlink_prev, oldlink_next, oldkey, oldvalue = oldlink
+				oldlink_prev, oldlink_next, oldkey, oldvalue, oldsize = oldlink
 				head[NEXT] = oldlink_next
 				oldlink_next[PREV] = head
 				del cache[oldkey]
+				self.__cur_size -= oldsize
+				oldvalues.append(oldvalue)
 
 			last = tail[PREV]
-			link = [last, tail, key, value]
+			link = [last, tail, key, value, size]
 			cache[key] = last[NEXT] = tail[PREV] = link
+			self.__cur_size += size
 
-		if oldlink is not sentinel and self.__disposefunc:
-			self.__disposefunc(oldvalue)
+		if self.__disposefunc:
+			for oldvalue in oldvalues:
+				self.__disposefunc(oldvalue)
 
 	def clear(self):
 		PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
@@ -90,9 +104,10 @@ class LRUCache(collections.MutableMapping):
 		with self.__lock:
 			oldlinks = cache.values()
 			cache.clear()
+			self.__cur_size = 0
 
-			self.__head = [ None, None, None, None ]
-			self.__tail = [ self.__head, None, None, None ]
+			self.__head = [ None, None, None, None, 0 ]
+			self.__tail = [ self.__head, None, None, None, 0 ]
 			self.__head[NEXT] = self.__tail
 
 		if self.__disposefunc:
@@ -114,6 +129,9 @@ class LRUCache(collections.MutableMapping):
 	def getsize(self):
 		return self.__cache_size
 
+	def getcursize(self):
+		return self.__cur_size
+
 	def keys(self):
 		return [ i[0] for i in self.items() ]
 
@@ -0,0 +1,152 @@
+# Connection pool spreading requests over several replicas of one service
+#
+# This module is part of python-connectionpool and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php
+
+
+import httplib
+import random
+import threading
+import time
+
+from .connectionpool import SingleHostConnectionPool
+
+
+class _Replica:
+	"""Single host pool together with its load statistics"""
+
+	def __init__(self, key, pool):
+		self.key = key
+		self.pool = pool
+		self.outstanding = 0
+		self.latency = 0.0
+		self.measured = 0.0
+		self.down_until = 0.0
+
+
+class ReplicaSetPool:
+	"""Connection pool balancing requests over replicas of one service"""
+
+	SingleHostPoolCls = SingleHostConnectionPool
+
+	LEAST_OUTSTANDING = "least_outstanding"
+	TWO_CHOICES = "two_choices"
+
+	# Errors escaping single host pool which take replica out of rotation
+	FAILURE_ERRORS = (EnvironmentError, httplib.HTTPException)
+
+	def __init__(
+		self, connection_factory, replicas,
+		balancer=TWO_CHOICES, latency_decay=0.3, latency_half_life=10.0, fail_timeout=10.0,
+		pool_size=1, pool_block=False, pool_timeout=None, tracer=None, hooks=None):
+
+		if balancer not in (self.LEAST_OUTSTANDING, self.TWO_CHOICES):
+			raise ValueError("Unknown balancer: {0}".format(balancer))
+		if not replicas:
+			raise ValueError("Replica set is empty")
+
+		self.__balancer = balancer
+		self.__latency_decay = latency_decay
+		self.__latency_half_life = latency_half_life
+		self.__fail_timeout = fail_timeout
+		self.__lock = threading.Lock()
+
+		self.__replicas = []
+		for host, port in replicas:
+			pool = self.SingleHostPoolCls(
+				lambda host=host, port=port: connection_factory(host, port),
+				pool_size=pool_size, pool_block=pool_block, pool_timeout=pool_timeout,
+				tracer=tracer, hooks=hooks)
+			self.__replicas.append(_Replica((host, port), pool))
+
+	def get_replicas(self):
+		"""Return (host, port) pairs of all replicas"""
+
+		return [ r.key for r in self.__replicas ]
+
+	def get_stats(self):
+		"""Return (host, port), outstanding requests, latency EWMA and health of every replica"""
+
+		now = time.time()
+		with self.__lock:
+			return [
+				(r.key, r.outstanding, self.__latency(r, now), r.down_until <= now)
+				for r in self.__replicas ]
+
+	def close(self):
+		"""Close all replica pools"""
+
+		for replica in self.__replicas:
+			replica.pool.close()
+
+	def __latency(self, replica, now):
+		"""Latency EWMA fading toward zero while replica is not measured
+
+		Replica avoided after a few slow responses gets requests again and
+		with them fresh measurements.
+		"""
+
+		if not replica.latency:
+			return replica.latency
+		return replica.latency * 0.5 ** ((now - replica.measured) / self.__latency_half_life)
+
+	def _choose(self):
+		"""Pick replica for next request and account it as outstanding"""
+
+		now = time.time()
+		with self.__lock:
+			candidates = [ r for r in self.__replicas if r.down_until <= now ]
+			if not candidates:
+				# Everything is failing, let requests probe all replicas
+				candidates = self.__replicas
+
+			if self.__balancer == self.TWO_CHOICES:
+				if len(candidates) > 2:
+					candidates = random.sample(candidates, 2)
+				# Peak EWMA style cost: slow replicas look busier than they are
+				replica = min(
+					candidates, key=lambda r: (self.__latency(r, now) * (r.outstanding + 1), r.outstanding))
+			else:
+				replica = min(candidates, key=lambda r: (r.outstanding, self.__latency(r, now)))
+
+			replica.outstanding += 1
+			return replica
+
+	def _release(self, replica, latency=None, failed=False):
+		"""Update replica statistics after request finished"""
+
+		with self.__lock:
+			replica.outstanding -= 1
+			if failed:
+				replica.down_until = time.time() + self.__fail_timeout
+			elif latency is not None:
+				now = time.time()
+				replica.down_until = 0.0
+				current = self.__latency(replica, now)
+				if current:
+					replica.latency = current + self.__latency_decay * (latency - current)
+				else:
+					replica.latency = latency
+				replica.measured = now
+
+	def _balance(self, pool_request):
+		"""Run pool_request against single host pool of least loaded replica"""
+
+		replica = self._choose()
+		start = time.time()
+		try:
+			result = pool_request(replica.pool)
+		except self.FAILURE_ERRORS:
+			self._release(replica, failed=True)
+			raise
+		except:
+			self._release(replica)
+			raise
+
+		self._release(replica, latency=time.time() - start)
+		return result
+
+	def request(self, callback):
+		"""Get connection from least loaded replica and pass it to callback"""
+
+		return self._balance(lambda pool: pool.request(callback))
@@ -0,0 +1,57 @@
+# Duplicate call suppression: concurrent callers asking for the same key
+# wait for one in-flight call and share its result.
+#
+# This module is part of python-connectionpool and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php
+
+
+import sys
+import threading
+
+
+class _Call:
+
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+		self.exc_info = None
+
+
+class SingleFlight:
+	"""Runs at most one call per key, concurrent callers share its outcome"""
+
+	def __init__(self):
+		self.__lock = threading.Lock()
+		self.__calls = {}
+
+	def do(self, key, func):
+		"""Call func unless call for key is in flight, return or raise its outcome"""
+
+		with self.__lock:
+			call = self.__calls.get(key)
+			leader = call is None
+			if leader:
+				call = self.__calls[key] = _Call()
+
+		if not leader:
+			call.done.wait()
+			if call.exc_info is not None:
+				raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+			return call.result
+
+		try:
+			call.result = func()
+		except:
+			call.exc_info = sys.exc_info()
+			raise
+		finally:
+			with self.__lock:
+				del self.__calls[key]
+			call.done.set()
+		return call.result
+
+	def in_flight(self):
+		"""Return number of calls currently in flight"""
+
+		with self.__lock:
+			return len(self.__calls)
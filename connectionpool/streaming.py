@@ -0,0 +1,214 @@
+# Streaming request bodies written straight to connection socket: regular
+# files with sendfile(2), buffers without copying and iterables with
+# chunked transfer encoding.
+#
+# This module is part of python-connectionpool and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php
+
+
+import ctypes
+import ctypes.util
+import errno
+import mmap
+import os
+import select
+import socket
+import stat
+import sys
+
+
+_BLOCK_SIZE = 64 * 1024
+# Largest count Linux sendfile(2) transfers in one call
+_SENDFILE_MAX = 0x7ffff000
+# Chunks up to this size are framed with single send, larger ones are not copied
+_CHUNK_COPY_LIMIT = 16 * 1024
+
+_BUFFER_TYPES = (memoryview, bytearray, buffer, mmap.mmap)
+# sendfile(2) errors meaning that file can not be sent this way
+_SENDFILE_UNSUPPORTED = frozenset([errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP])
+
+
+def _libc_sendfile():
+	"""Return sendfile(out_fd, in_fd, offset, count) backed by libc or None"""
+
+	if not sys.platform.startswith("linux"):
+		return None
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		func = libc.sendfile64
+	except (OSError, AttributeError):
+		return None
+	func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+	func.restype = ctypes.c_ssize_t
+
+	def sendfile(out_fd, in_fd, offset, count):
+		sent = func(out_fd, in_fd, ctypes.byref(ctypes.c_int64(offset)), count)
+		if sent < 0:
+			error = ctypes.get_errno()
+			raise OSError(error, os.strerror(error))
+		return sent
+	return sendfile
+
+
+_sendfile = getattr(os, "sendfile", None) or _libc_sendfile()
+
+
+def _buffer_len(data):
+	if isinstance(data, memoryview):
+		return len(data) * data.itemsize
+	return len(data)
+
+
+def _wait_writable(sock):
+	_, writable, _ = select.select([], [sock], [], sock.gettimeout())
+	if not writable:
+		raise socket.timeout("timed out")
+
+
+class _StreamingBody:
+	"""Common part of request bodies sent by pool instead of httplib
+
+	Subclasses write whole body to socket in send(sock, chunked), length
+	is None for bodies of unknown size which are always sent chunked.
+	"""
+
+	length = None
+
+	def rewind(self):
+		"""Prepare body to be sent again, returns False if it can not be replayed"""
+
+		return True
+
+
+class _FileBody(_StreamingBody):
+
+	def __init__(self, fileobj, fd, size):
+		self.__file = fileobj
+		self.__fd = fd
+		self.__start = fileobj.tell()
+		self.length = max(0, size - self.__start)
+
+	def rewind(self):
+		self.__file.seek(self.__start)
+		return True
+
+	def send(self, sock, chunked=False):
+		if chunked and self.length:
+			# Whole file goes as one chunk
+			sock.sendall("%x\r\n" % self.length)
+		sent = 0
+		if _sendfile is not None:
+			sent = self.__sendfile(sock)
+		if sent < self.length:
+			self.__copy(sock, sent)
+		self.__file.seek(self.__start + self.length)
+		if chunked:
+			sock.sendall("\r\n0\r\n\r\n" if self.length else "0\r\n\r\n")
+
+	def __sendfile(self, sock):
+		"""Send as much as possible with sendfile(2), returns bytes sent"""
+
+		# Offset is passed explicitly so file position is left untouched
+		sent = 0
+		while sent < self.length:
+			try:
+				count = _sendfile(
+					sock.fileno(), self.__fd, self.__start + sent, min(self.length - sent, _SENDFILE_MAX))
+			except OSError as e:
+				if e.errno == errno.EAGAIN:
+					# Socket with timeout is non blocking
+					_wait_writable(sock)
+					continue
+				if e.errno in _SENDFILE_UNSUPPORTED:
+					break
+				raise socket.error(e.errno, e.strerror)
+			if count == 0:
+				raise IOError("File shrank while being sent")
+			sent += count
+		return sent
+
+	def __copy(self, sock, sent):
+		self.__file.seek(self.__start + sent)
+		block = memoryview(bytearray(min(_BLOCK_SIZE, self.length - sent)))
+		while sent < self.length:
+			count = self.__file.readinto(block[:min(len(block), self.length - sent)])
+			if not count:
+				raise IOError("File shrank while being sent")
+			sock.sendall(block[:count])
+			sent += count
+
+
+class _BufferBody(_StreamingBody):
+
+	def __init__(self, data):
+		self.__data = data
+		self.length = _buffer_len(data)
+
+	def send(self, sock, chunked=False):
+		if chunked:
+			_send_chunk(sock, self.__data)
+			sock.sendall("0\r\n\r\n")
+		else:
+			sock.sendall(self.__data)
+
+
+class _IterableBody(_StreamingBody):
+
+	def __init__(self, iterable):
+		self.__iterable = iterable
+		self.__started = False
+
+	def rewind(self):
+		return not self.__started
+
+	def send(self, sock, chunked=False):
+		self.__started = True
+		for data in self.__iterable:
+			if chunked:
+				_send_chunk(sock, data)
+			elif data:
+				sock.sendall(data)
+		if chunked:
+			sock.sendall("0\r\n\r\n")
+
+
+def _send_chunk(sock, data):
+	size = _buffer_len(data)
+	if not size:
+		# Empty chunk would terminate body
+		return
+	if size <= _CHUNK_COPY_LIMIT:
+		data = data.tobytes() if isinstance(data, memoryview) else data[:]
+		sock.sendall("%x\r\n%s\r\n" % (size, data))
+	else:
+		sock.sendall("%x\r\n" % size)
+		sock.sendall(data)
+		sock.sendall("\r\n")
+
+
+def streaming_body(body):
+	"""Wrap request body which should bypass httplib, returns None for plain bodies
+
+	Regular files are sent from current position with sendfile(2), buffers
+	(memoryview, bytearray, mmap) as they are, other file-like objects and
+	iterables chunk by chunk.
+	"""
+
+	if body is None or isinstance(body, basestring):
+		return None
+	if isinstance(body, _BUFFER_TYPES):
+		return _BufferBody(body)
+
+	if hasattr(body, "read"):
+		try:
+			fd = body.fileno()
+			st = os.fstat(fd)
+		except (AttributeError, EnvironmentError, ValueError):
+			st = None
+		if st is not None and stat.S_ISREG(st.st_mode):
+			return _FileBody(body, fd, st.st_size)
+		return _IterableBody(iter(lambda: body.read(_BLOCK_SIZE), ""))
+
+	if hasattr(body, "__iter__"):
+		return _IterableBody(body)
+	return None
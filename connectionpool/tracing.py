@@ -0,0 +1,147 @@
+# Per-request timing breakdown and tracing hooks
+#
+# This module is part of python-connectionpool and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php
+
+
+import random
+import time
+
+
+class RequestTrace:
+	"""Phase timestamps of one request
+
+	Phases are (name, timestamp) pairs in the order they happened:
+	pool_wait, dns, connect, send, first_byte and body.  Connection
+	phases appear only when a new connection had to be created.
+	"""
+
+	def __init__(self, name, attributes):
+		self.name = name
+		self.attributes = attributes
+		self.start = time.time()
+		self.end = None
+		self.phases = []
+		self.reused = None
+		self.retries = 0
+		self.error = None
+
+	def mark(self, phase, timestamp=None):
+		"""Record that phase ended now or at given timestamp"""
+
+		self.phases.append((phase, timestamp or time.time()))
+
+	def checkout(self, conn, created):
+		"""Record connection checkout, with connect phases for new connections"""
+
+		if created:
+			self.phases.extend(getattr(conn, "timings", None) or [("connect", time.time())])
+		self.reused = not created
+
+	def durations(self):
+		"""Return (phase, seconds) pairs, each phase measured from previous one"""
+
+		result = []
+		last = self.start
+		for phase, timestamp in self.phases:
+			result.append((phase, timestamp - last))
+			last = timestamp
+		return result
+
+
+class Tracer:
+	"""Samples requests and receives their traces when they finish"""
+
+	def __init__(self, callback=None, sample_rate=1.0):
+		self.__callback = callback
+		self.__sample_rate = sample_rate
+
+	def start(self, name, **attributes):
+		"""Return new trace, or None when request is not sampled"""
+
+		if self.__sample_rate < 1.0 and random.random() >= self.__sample_rate:
+			return None
+		return RequestTrace(name, attributes)
+
+	def fail(self, trace, error):
+		"""Finish trace of request which raised error"""
+
+		trace.error = error
+		self.finish(trace)
+
+	def finish(self, trace):
+		"""Finish trace and export it, only first call has effect"""
+
+		if trace.end is None:
+			trace.end = time.time()
+			self.export(trace)
+
+	def export(self, trace):
+		"""Pass finished trace to callback, override to export elsewhere"""
+
+		if self.__callback is not None:
+			self.__callback(trace)
+
+
+def _ns(timestamp):
+	return int(timestamp * 1e9)
+
+
+class OpenTelemetryTracer(Tracer):
+	"""Exports traces as spans through OpenTelemetry style tracer
+
+	Span is started with start_span(name, start_time=, attributes=), phases
+	are added with add_event(name, timestamp=) and span is closed with
+	end(end_time=); timestamps are in nanoseconds.
+	"""
+
+	def __init__(self, otel_tracer, sample_rate=1.0):
+		Tracer.__init__(self, sample_rate=sample_rate)
+		self.__otel_tracer = otel_tracer
+
+	def export(self, trace):
+		attributes = dict(trace.attributes)
+		attributes["pool.retries"] = trace.retries
+		if trace.reused is not None:
+			attributes["pool.reused"] = trace.reused
+
+		span = self.__otel_tracer.start_span(
+			trace.name, start_time=_ns(trace.start), attributes=attributes)
+		for phase, timestamp in trace.phases:
+			span.add_event(phase, timestamp=_ns(timestamp))
+		if trace.error is not None:
+			span.set_attribute("error", True)
+			if hasattr(span, "record_exception"):
+				span.record_exception(trace.error)
+		span.end(end_time=_ns(trace.end))
+
+
+class TracedResponse:
+	"""Response proxy finishing trace when body is read or response closed"""
+
+	def __init__(self, response, trace, tracer):
+		self.__response = response
+		self.__trace = trace
+		self.__tracer = tracer
+
+	def __getattr__(self, name):
+		return getattr(self.__response, name)
+
+	def read(self, amt=None):
+		try:
+			data = self.__response.read(amt)
+		except Exception as e:
+			self.__tracer.fail(self.__trace, e)
+			raise
+		if amt is None or not data:
+			self.__done()
+		return data
+
+	def close(self):
+		self.__response.close()
+		self.__done()
+
+	def __done(self):
+		if self.__trace.end is None:
+			self.__trace.mark("body")
+			self.__tracer.finish(self.__trace)
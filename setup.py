@@ -7,5 +7,6 @@ setup(
 	description="Simple connection pool framework",
 	license="MIT",
 	packages=find_packages(exclude=["test"]),
+	extras_require={"http2": ["h2"]},
 	test_suite="test"
 )
@@ -0,0 +1,228 @@
+import unittest
+import threading
+import shutil
+import socket
+import tempfile
+import time
+import os
+import BaseHTTPServer
+import SocketServer
+
+from connectionpool import broker
+from connectionpool import connectionpool
+from connectionpool import httpconnectionpool
+
+
+class FakeUpstream:
+	def __init__(self, family=socket.AF_INET, host="127.0.0.1"):
+		self.listener = socket.socket(family, socket.SOCK_STREAM)
+		self.listener.bind((host, 0))
+		self.listener.listen(16)
+		self.port = self.listener.getsockname()[1]
+		self.accepted = []
+		self.thread = threading.Thread(target=self.serve)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def serve(self):
+		try:
+			while True:
+				self.accepted.append(self.listener.accept()[0])
+		except socket.error:
+			pass
+
+	def wait_accepted(self, count):
+		for _ in xrange(100):
+			if len(self.accepted) >= count:
+				return self.accepted
+			time.sleep(0.01)
+		raise AssertionError("Upstream connection was not accepted")
+
+	def close(self):
+		for sock in self.accepted:
+			sock.close()
+		self.listener.close()
+
+
+class FakeHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def do_GET(self):
+		self.server.connections.add(self.client_address)
+		self.send_response(200)
+		self.send_header("Content-Length", "2")
+		self.end_headers()
+		self.wfile.write("ok")
+
+	def log_message(self, *args):
+		pass
+
+
+class FakeHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+
+class FakeSocketFactory:
+	def __init__(self):
+		self.counter = 0
+
+	def __call__(self, host, port):
+		self.counter += 1
+		return socket.create_connection((host, port))
+
+
+class TestPoolBroker(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.path = os.path.join(self.tmpdir, "broker.sock")
+		self.upstream = FakeUpstream()
+		self.factory = FakeSocketFactory()
+		self.clients = []
+
+	def tearDown(self):
+		for client in self.clients:
+			client.close()
+		self.pool_broker.close()
+		self.upstream.close()
+		shutil.rmtree(self.tmpdir)
+
+	def start_broker(self, **kwargs):
+		self.pool_broker = broker.PoolBroker(self.path, connection_factory=self.factory, **kwargs)
+		self.pool_broker.start()
+
+	def client(self):
+		client = broker.BrokerClient(self.path)
+		self.clients.append(client)
+		return client
+
+	def test_lent_socket_reaches_upstream(self):
+		self.start_broker()
+		sock = self.client().acquire("127.0.0.1", self.upstream.port)
+		sock.sendall("ping")
+		self.assertEquals(self.upstream.wait_accepted(1)[0].recv(4), "ping")
+		sock.close()
+
+	def test_socket_reuse(self):
+		self.start_broker()
+		client = self.client()
+		sock = client.acquire("127.0.0.1", self.upstream.port)
+		client.release("127.0.0.1", self.upstream.port, sock)
+		sock = client.acquire("127.0.0.1", self.upstream.port)
+		client.release("127.0.0.1", self.upstream.port, sock)
+		self.assertEquals(self.factory.counter, 1)
+
+	def test_broken_socket_is_dropped(self):
+		self.start_broker()
+		client = self.client()
+		sock = client.acquire("127.0.0.1", self.upstream.port)
+		self.upstream.wait_accepted(1)[0].close()
+		time.sleep(0.05)
+		client.release("127.0.0.1", self.upstream.port, sock)
+		sock = client.acquire("127.0.0.1", self.upstream.port)
+		sock.close()
+		self.assertEquals(self.factory.counter, 2)
+
+	def test_pool_exhausting(self):
+		self.start_broker(pool_size=1)
+		client = self.client()
+		sock = client.acquire("127.0.0.1", self.upstream.port)
+		self.assertRaises(
+			connectionpool.PoolIsEmptyError,
+			lambda: client.acquire("127.0.0.1", self.upstream.port))
+		sock.close()
+
+	def test_slots_reclaimed_on_disconnect(self):
+		self.start_broker(pool_size=1)
+		client = self.client()
+		client.acquire("127.0.0.1", self.upstream.port).close()
+		client.close()
+
+		other = self.client()
+		for _ in xrange(100):
+			try:
+				other.acquire("127.0.0.1", self.upstream.port).close()
+				break
+			except connectionpool.PoolIsEmptyError:
+				time.sleep(0.01)
+		else:
+			self.fail("Broker should reclaim connections of closed client")
+
+	def test_socket_family(self):
+		try:
+			upstream = FakeUpstream(socket.AF_INET6, "::1")
+		except socket.error:
+			self.skipTest("IPv6 is not available")
+		try:
+			self.start_broker()
+			client = self.client()
+			sock = client.acquire("::1", upstream.port)
+			self.assertEquals(sock.family, socket.AF_INET6)
+			self.assertEquals(sock.getpeername()[:2], ("::1", upstream.port))
+			client.release("::1", upstream.port, sock)
+			sock = client.acquire("::1", upstream.port)
+			self.assertEquals(sock.family, socket.AF_INET6)
+			sock.close()
+			self.assertEquals(self.factory.counter, 1)
+		finally:
+			upstream.close()
+
+	def test_broker_unavailable(self):
+		self.pool_broker = broker.PoolBroker(self.path)
+		self.pool_broker.close()
+		self.assertEquals(self.client().acquire("127.0.0.1", self.upstream.port), None)
+
+
+class TestBrokeredHTTPConnectionPool(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.path = os.path.join(self.tmpdir, "broker.sock")
+		self.server = FakeHTTPServer(("127.0.0.1", 0), FakeHTTPHandler)
+		self.server.connections = set()
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		self.port = self.server.server_address[1]
+		self.factory = FakeSocketFactory()
+		self.pool_broker = broker.PoolBroker(self.path, connection_factory=self.factory, pool_size=1)
+		self.pool_broker.start()
+		self.pools = []
+
+	def tearDown(self):
+		for pool in self.pools:
+			pool.clear()
+		self.pool_broker.close()
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.tmpdir)
+
+	def pool(self, conn_timeout=None):
+		pool = httpconnectionpool.HTTPConnectionPool(
+			broker_path=self.path, conn_timeout=conn_timeout, net_timeout=5)
+		self.pools.append(pool)
+		return pool
+
+	def test_idle_socket_returned_to_broker(self):
+		first, second = self.pool(), self.pool()
+		self.assertEquals(first.request("127.0.0.1", self.port, "GET", "/").read(), "ok")
+		self.assertEquals(second.request("127.0.0.1", self.port, "GET", "/").read(), "ok")
+		self.assertEquals(first.request("127.0.0.1", self.port, "GET", "/").read(), "ok")
+		self.assertEquals(self.factory.counter, 1)
+		self.assertEquals(len(self.server.connections), 1)
+
+	def test_channel_with_timeout(self):
+		# Timeout makes broker channel non blocking
+		pools = [ self.pool(conn_timeout=5) for _ in xrange(2) ]
+		for i in xrange(100):
+			self.assertEquals(pools[i % 2].request("127.0.0.1", self.port, "GET", "/").read(), "ok")
+		self.assertEquals(self.factory.counter, 1)
+		self.assertEquals(len(self.server.connections), 1)
+
+	def test_exhausted_broker_falls_back_to_own_connection(self):
+		first, second = self.pool(), self.pool()
+		resp = first.request("127.0.0.1", self.port, "GET", "/")
+		self.assertEquals(second.request("127.0.0.1", self.port, "GET", "/").read(), "ok")
+		self.assertEquals(resp.read(), "ok")
+		self.assertEquals(self.factory.counter, 1)
+		self.assertEquals(len(self.server.connections), 2)
@@ -0,0 +1,329 @@
+import unittest
+import threading
+import httplib
+import socket
+import time
+import StringIO
+
+from connectionpool import connectionpool
+from connectionpool import http2connectionpool
+
+try:
+	import h2.config
+	import h2.connection
+	import h2.errors
+	import h2.events
+	import h2.settings
+except ImportError:
+	h2 = None
+
+
+class FakeHTTP2Server:
+	"""Local h2c server answering "<path>:<request body length>"
+
+	Responses are held back until `hold` requests are pending, which
+	forces clients to keep that many streams open at once.  "/large"
+	answers with LARGE_SIZE bytes sent as flow control allows, first
+	upload to "/drop" breaks its connection.
+	"""
+
+	LARGE_SIZE = 200000
+
+	def __init__(self, max_streams=100, hold=1):
+		self.max_streams = max_streams
+		self.hold = hold
+		self.pending = []
+		self.connections = 0
+		self.large_sent = 0
+		self.dropped = False
+		self.lock = threading.Lock()
+		self.open_connections = []
+		self.handlers = []
+
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.bind(("127.0.0.1", 0))
+		self.listener.listen(16)
+		self.port = self.listener.getsockname()[1]
+		thread = threading.Thread(target=self.serve)
+		thread.daemon = True
+		thread.start()
+
+	def serve(self):
+		try:
+			while True:
+				sock = self.listener.accept()[0]
+				with self.lock:
+					self.connections += 1
+				thread = threading.Thread(target=self.handle, args=(sock,))
+				thread.daemon = True
+				thread.start()
+				with self.lock:
+					self.handlers.append(thread)
+		except socket.error:
+			pass
+
+	def handle(self, sock):
+		conn = h2.connection.H2Connection(
+			config=h2.config.H2Configuration(client_side=False, header_encoding=None))
+		conn.local_settings = h2.settings.Settings(
+			client=False,
+			initial_values={h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: self.max_streams})
+		conn_lock = threading.Lock()
+		requests = {}
+		outgoing = {}
+		with conn_lock:
+			conn.initiate_connection()
+			sock.sendall(conn.data_to_send())
+		with self.lock:
+			self.open_connections.append((sock, conn, conn_lock))
+		try:
+			while True:
+				data = sock.recv(65536)
+				if not data:
+					break
+				ready = []
+				with conn_lock:
+					for event in conn.receive_data(data):
+						if isinstance(event, h2.events.RequestReceived):
+							requests[event.stream_id] = [dict(event.headers), 0]
+						elif isinstance(event, h2.events.DataReceived):
+							if requests[event.stream_id][0][":path"] == "/drop" and not self.dropped:
+								# Connection breaks in the middle of upload
+								self.dropped = True
+								raise socket.error("dropped")
+							requests[event.stream_id][1] += len(event.data)
+							conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+						elif isinstance(event, h2.events.StreamEnded):
+							ready.append(event.stream_id)
+						elif isinstance(event, h2.events.StreamReset):
+							outgoing.pop(event.stream_id, None)
+					self.send_outgoing(conn, outgoing)
+					sock.sendall(conn.data_to_send())
+				for stream_id in ready:
+					self.respond(sock, conn, conn_lock, outgoing, stream_id, *requests.pop(stream_id))
+		except socket.error:
+			pass
+		sock.close()
+
+	def send_outgoing(self, conn, outgoing):
+		for stream_id, body in outgoing.items():
+			while body:
+				size = min(len(body), conn.local_flow_control_window(stream_id), conn.max_outbound_frame_size)
+				if not size:
+					break
+				conn.send_data(stream_id, body[:size], end_stream=size == len(body))
+				body = body[size:]
+				with self.lock:
+					self.large_sent += size
+			if body:
+				outgoing[stream_id] = body
+			else:
+				del outgoing[stream_id]
+
+	def respond(self, sock, conn, conn_lock, outgoing, stream_id, headers, length):
+		with self.lock:
+			self.pending.append((sock, conn, conn_lock, outgoing, stream_id, headers, length))
+			if len(self.pending) < self.hold:
+				return
+			pending, self.pending = self.pending, []
+
+		for sock, conn, conn_lock, outgoing, stream_id, headers, length in pending:
+			with conn_lock:
+				if headers[":path"] == "/reset":
+					conn.reset_stream(stream_id, h2.errors.ErrorCodes.REFUSED_STREAM)
+				elif headers[":path"] == "/large":
+					conn.send_headers(stream_id, [
+						(":status", "200"), ("content-length", str(self.LARGE_SIZE))])
+					outgoing[stream_id] = "x" * self.LARGE_SIZE
+					self.send_outgoing(conn, outgoing)
+				else:
+					body = "{0}:{1}".format(headers[":path"], length)
+					conn.send_headers(stream_id, [
+						(":status", "200"), ("content-length", str(len(body))),
+						("x-method", headers[":method"])])
+					conn.send_data(stream_id, body, end_stream=True)
+				sock.sendall(conn.data_to_send())
+
+	def limit_streams(self, max_streams):
+		"""Lower MAX_CONCURRENT_STREAMS on open connections"""
+
+		with self.lock:
+			connections = list(self.open_connections)
+		for sock, conn, conn_lock in connections:
+			with conn_lock:
+				conn.update_settings({h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: max_streams})
+				sock.sendall(conn.data_to_send())
+
+	def close(self):
+		self.listener.close()
+		# Handlers must not outlive test, they would fail at interpreter shutdown
+		with self.lock:
+			connections, handlers = list(self.open_connections), list(self.handlers)
+		for sock, _, _ in connections:
+			try:
+				sock.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+		for thread in handlers:
+			thread.join(5)
+
+
+@unittest.skipIf(h2 is None, "h2 package is not installed")
+class TestHTTP2ConnectionPool(unittest.TestCase):
+
+	def tearDown(self):
+		self.pool.clear()
+		self.server.close()
+
+	def start(self, max_streams=100, hold=1, **kwargs):
+		self.server = FakeHTTP2Server(max_streams=max_streams, hold=hold)
+		self.pool = http2connectionpool.HTTP2ConnectionPool(**kwargs)
+
+	def request(self, url, results, **kwargs):
+		resp = self.pool.request("127.0.0.1", self.server.port, "GET", url, **kwargs)
+		results.append((resp.status, resp.read()))
+
+	def concurrent_requests(self, count):
+		results = []
+		threads = [
+			threading.Thread(target=self.request, args=("/{0}".format(i), results))
+			for i in xrange(count) ]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join(5)
+		return results
+
+	def test_request(self):
+		self.start()
+		resp = self.pool.request("127.0.0.1", self.server.port, "GET", "/path")
+		self.assertEquals(resp.status, 200)
+		self.assertEquals(resp.getheader("X-Method"), "GET")
+		self.assertEquals(resp.getheader("x-missing", "default"), "default")
+		self.assertEquals(resp.read(3), "/pa")
+		self.assertEquals(resp.read(), "th:0")
+
+	def test_streams_share_connection(self):
+		self.start(hold=5)
+		results = self.concurrent_requests(5)
+		self.assertEquals(
+			sorted(results), [ (200, "/{0}:0".format(i)) for i in xrange(5) ])
+		self.assertEquals(self.server.connections, 1)
+
+	def test_max_concurrent_streams(self):
+		self.start(max_streams=2, hold=4)
+		results = self.concurrent_requests(4)
+		self.assertEquals(len(results), 4)
+		self.assertEquals(self.server.connections, 2)
+		self.assertEquals(self.pool.get("127.0.0.1", self.server.port).get_connection_count(), 2)
+
+	def test_pool_exhausting(self):
+		self.start(max_streams=1, pool_size=1)
+		pool = self.pool.get("127.0.0.1", self.server.port)
+
+		def _failcallback(conn):
+			self.fail("Connection pool should be exhausing at this point")
+
+		def _callback(conn):
+			self.assertRaises(
+				connectionpool.PoolIsEmptyError,
+				lambda: connectionpool.SingleHostConnectionPool.request(pool, _failcallback))
+		connectionpool.SingleHostConnectionPool.request(pool, _callback)
+
+		# unused slot was given back
+		results = []
+		self.request("/again", results)
+		self.assertEquals(results, [(200, "/again:0")])
+
+	def test_large_body(self):
+		self.start()
+		body = "x" * 300000
+		resp = self.pool.request("127.0.0.1", self.server.port, "POST", "/upload", body=body)
+		self.assertEquals(resp.read(), "/upload:300000")
+
+	def test_upload_retried_from_start(self):
+		self.start()
+		body = StringIO.StringIO("x" * 300000)
+		body.seek(100)
+		resp = self.pool.request("127.0.0.1", self.server.port, "POST", "/drop", body=body)
+		self.assertEquals(resp.read(), "/drop:299900")
+		self.assertTrue(self.server.dropped)
+		self.assertEquals(self.server.connections, 2)
+
+	def test_stream_reset(self):
+		self.start()
+		self.assertRaises(
+			http2connectionpool.HTTP2StreamError,
+			lambda: self.pool.request("127.0.0.1", self.server.port, "GET", "/reset"))
+		results = []
+		self.request("/after", results)
+		self.assertEquals(results, [(200, "/after:0")])
+		self.assertEquals(self.server.connections, 1)
+
+	def test_stream_protocol_error_keeps_connection(self):
+		self.start(max_streams=2)
+		held = self.pool.request("127.0.0.1", self.server.port, "GET", "/large")
+		conn = self.pool.get("127.0.0.1", self.server.port)._get_conn()
+		reserve = conn.conn.reserve
+		conn.conn.release()
+
+		def _stale_reserve():
+			# Server lowers its limit right after slot was reserved
+			conn.conn.reserve = reserve
+			reserved = reserve()
+			self.server.limit_streams(1)
+			time.sleep(0.2)
+			return reserved
+		conn.conn.reserve = _stale_reserve
+
+		results = []
+		self.request("/after", results)
+		self.assertEquals(results, [(200, "/after:0")])
+		self.assertEquals(len(held.read()), FakeHTTP2Server.LARGE_SIZE)
+		self.assertEquals(self.server.connections, 2)
+
+	def test_rejected_headers_fail_connection(self):
+		self.start()
+		# h2 rejects custom pseudo header after HPACK state was updated
+		self.assertRaises(
+			httplib.HTTPException,
+			lambda: self.pool.request("127.0.0.1", self.server.port, "GET", "/bad", headers={":bogus": "x"}))
+		results = []
+		self.request("/after", results)
+		self.assertEquals(results, [(200, "/after:0")])
+
+	def test_flow_control_follows_reader(self):
+		self.start()
+		resp = self.pool.request("127.0.0.1", self.server.port, "GET", "/large")
+		time.sleep(0.2)
+		# Nothing was read, server is limited to initial window
+		self.assertTrue(self.server.large_sent <= 65535)
+		self.assertEquals(len(resp.read()), FakeHTTP2Server.LARGE_SIZE)
+		self.assertEquals(self.server.large_sent, FakeHTTP2Server.LARGE_SIZE)
+
+	def test_unread_stream_does_not_stall_connection(self):
+		self.start(net_timeout=2)
+		resp = self.pool.request("127.0.0.1", self.server.port, "GET", "/large")
+		results = []
+		for i in xrange(3):
+			self.request("/after{0}".format(i), results)
+		self.assertEquals(results, [ (200, "/after{0}:0".format(i)) for i in xrange(3) ])
+		self.assertEquals(self.server.connections, 1)
+		self.assertEquals(len(resp.read()), FakeHTTP2Server.LARGE_SIZE)
+
+	def test_closed_response_frees_slot(self):
+		self.start(max_streams=1, pool_size=1)
+		resp = self.pool.request("127.0.0.1", self.server.port, "GET", "/large")
+		resp.read(10)
+		resp.close()
+		results = []
+		self.request("/after", results)
+		self.assertEquals(results, [(200, "/after:0")])
+		self.assertEquals(self.server.connections, 1)
+
+	def test_closed_pool(self):
+		self.start()
+		pool = self.pool.get("127.0.0.1", self.server.port)
+		pool.request("GET", "/").read()
+		pool.close()
+		self.assertRaises(connectionpool.PoolIsClosedError, lambda: pool.request("GET", "/"))
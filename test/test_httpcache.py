@@ -0,0 +1,256 @@
+import unittest
+import email.utils
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+
+from connectionpool import httpcache
+from connectionpool import httpconnectionpool
+
+
+class FakeResponse:
+	def __init__(self, status, headers, body=""):
+		self.status = status
+		self.reason = "OK"
+		self.version = 11
+		self.headers = headers
+		self.body = body
+		self.offset = 0
+		self.reads = 0
+
+	def getheader(self, name, default=None):
+		return dict(self.headers).get(name.lower(), default)
+
+	def getheaders(self):
+		return list(self.headers)
+
+	def read(self, amt=None):
+		self.reads += 1
+		start = self.offset
+		self.offset = len(self.body) if amt is None else min(len(self.body), start + amt)
+		return self.body[start:self.offset]
+
+	def isclosed(self):
+		return self.offset >= len(self.body)
+
+
+class FakeSender:
+	def __init__(self, *responses):
+		self.responses = list(responses)
+		self.requests = []
+
+	def __call__(self, method, url, body, headers):
+		self.requests.append((method, url, headers))
+		return self.responses.pop(0)
+
+
+class FakeHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def do_GET(self):
+		self.server.requests.append(self.path)
+		body = "data"
+		self.send_response(200)
+		self.send_header("Cache-Control", "max-age=60")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+class FakeHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+
+class TestHTTPResponseCache(unittest.TestCase):
+
+	def request(self, cache, send, method="GET", url="/", headers={}):
+		return cache.request(send, "host", 80, method, url, headers=headers)
+
+	def test_fresh_hit(self):
+		cache = httpcache.HTTPResponseCache()
+		send = FakeSender(FakeResponse(200, [("cache-control", "max-age=60")], "body"))
+		self.assertEquals(self.request(cache, send).read(), "body")
+		resp = self.request(cache, send)
+		self.assertEquals(resp.status, 200)
+		self.assertEquals(resp.getheader("Cache-Control"), "max-age=60")
+		self.assertEquals(resp.read(2), "bo")
+		self.assertEquals(resp.read(), "dy")
+		self.assertEquals(len(send.requests), 1)
+		stats = cache.get_stats()
+		self.assertEquals((stats["hits"], stats["misses"], stats["bytes_saved"]), (1, 1, 4))
+		self.assertEquals(stats["entries"], 1)
+
+	def test_expires(self):
+		cache = httpcache.HTTPResponseCache()
+		now = time.time()
+		send = FakeSender(
+			FakeResponse(200, [
+				("date", email.utils.formatdate(now)),
+				("expires", email.utils.formatdate(now + 60))], "body"))
+		self.request(cache, send)
+		self.request(cache, send)
+		self.assertEquals(len(send.requests), 1)
+
+	def test_revalidation(self):
+		cache = httpcache.HTTPResponseCache()
+		not_modified = FakeResponse(304, [("etag", '"v1"'), ("content-length", "0")])
+		send = FakeSender(
+			FakeResponse(200, [("etag", '"v1"'), ("content-length", "4")], "body"),
+			not_modified)
+		self.request(cache, send)
+		resp = self.request(cache, send)
+		self.assertEquals(resp.status, 200)
+		self.assertEquals(resp.getheader("content-length"), "4")
+		self.assertEquals(resp.read(), "body")
+		self.assertEquals(send.requests[1][2], {"If-None-Match": '"v1"'})
+		self.assertEquals(not_modified.reads, 1)
+		stats = cache.get_stats()
+		self.assertEquals((stats["revalidations"], stats["bytes_saved"]), (1, 4))
+
+	def test_revalidation_changed(self):
+		cache = httpcache.HTTPResponseCache()
+		send = FakeSender(
+			FakeResponse(200, [("last-modified", "Mon, 01 Jan 2018 00:00:00 GMT"), ("cache-control", "no-cache")], "old"),
+			FakeResponse(200, [("cache-control", "no-store")], "new"))
+		self.request(cache, send)
+		self.assertEquals(self.request(cache, send).read(), "new")
+		self.assertEquals(
+			send.requests[1][2], {"If-Modified-Since": "Mon, 01 Jan 2018 00:00:00 GMT"})
+
+	def test_not_cacheable(self):
+		cache = httpcache.HTTPResponseCache()
+		uncacheable = [
+			FakeResponse(200, [], "no validators"),
+			FakeResponse(200, [("cache-control", "no-store, max-age=60")], "no-store"),
+			FakeResponse(200, [("cache-control", "max-age=60"), ("vary", "*")], "vary"),
+			FakeResponse(500, [("cache-control", "max-age=60")], "error") ]
+		for response in uncacheable:
+			send = FakeSender(response)
+			self.assertTrue(self.request(cache, send) is response)
+		self.assertEquals(cache.get_stats()["entries"], 0)
+
+	def test_request_bypass(self):
+		cache = httpcache.HTTPResponseCache()
+		send = FakeSender(*[ FakeResponse(200, [("cache-control", "max-age=60")], "body") for _ in xrange(4) ])
+		self.request(cache, send)
+		self.request(cache, send, headers={"Cache-Control": "no-cache"})
+		self.request(cache, send, method="HEAD")
+		self.request(cache, send, headers={"Range": "bytes=0-1"})
+		self.assertEquals(len(send.requests), 4)
+
+	def test_unsafe_method_invalidates(self):
+		cache = httpcache.HTTPResponseCache()
+		send = FakeSender(*[ FakeResponse(200, [("cache-control", "max-age=60")], "body") for _ in xrange(3) ])
+		self.request(cache, send)
+		self.request(cache, send, method="POST")
+		self.request(cache, send)
+		self.assertEquals(len(send.requests), 3)
+
+	def test_vary(self):
+		cache = httpcache.HTTPResponseCache()
+		send = FakeSender(*[
+			FakeResponse(200, [("cache-control", "max-age=60"), ("vary", "Accept")], "body")
+			for _ in xrange(2) ])
+		self.request(cache, send, headers={"Accept": "text/html"})
+		self.request(cache, send, headers={"accept": "text/html"})
+		self.request(cache, send, headers={"Accept": "application/json"})
+		self.assertEquals(len(send.requests), 2)
+
+	def test_bytes_limit(self):
+		cache = httpcache.HTTPResponseCache(max_bytes=4096, max_entry_bytes=2048)
+		send = FakeSender(*[
+			FakeResponse(200, [("cache-control", "max-age=60")], "x" * 1500)
+			for _ in xrange(4) ])
+		for url in ("/1", "/2", "/3"):
+			self.request(cache, send, url=url)
+		stats = cache.get_stats()
+		self.assertEquals(stats["entries"], 2)
+		self.assertTrue(stats["bytes_used"] <= 4096)
+		# oldest was evicted
+		self.request(cache, send, url="/1")
+		self.assertEquals(len(send.requests), 4)
+
+	def test_entry_too_large(self):
+		cache = httpcache.HTTPResponseCache(max_bytes=4096, max_entry_bytes=1024)
+		response = FakeResponse(200, [("cache-control", "max-age=60"), ("content-length", "2000")], "x" * 2000)
+		self.assertTrue(self.request(cache, FakeSender(response)) is response)
+		self.assertEquals(response.reads, 0)
+		self.assertEquals(cache.get_stats()["entries"], 0)
+
+	def test_entry_too_large_without_length(self):
+		cache = httpcache.HTTPResponseCache(max_bytes=4096, max_entry_bytes=1024)
+		body = "".join(chr(ord("a") + i % 26) for i in xrange(5000))
+		response = FakeResponse(200, [("cache-control", "max-age=60")], body)
+		resp = self.request(cache, FakeSender(response))
+		self.assertTrue(response.offset <= 1024)
+		self.assertEquals(resp.status, 200)
+		self.assertEquals(resp.read(10), body[:10])
+		self.assertFalse(resp.isclosed())
+		self.assertEquals(resp.read(), body[10:])
+		self.assertTrue(resp.isclosed())
+		self.assertEquals(cache.get_stats()["entries"], 0)
+
+	def test_authorization(self):
+		cache = httpcache.HTTPResponseCache()
+		auth = {"Authorization": "Basic dXNlcjpwYXNz"}
+		private = FakeResponse(200, [("cache-control", "max-age=60")], "private")
+		self.assertTrue(self.request(cache, FakeSender(private), headers=auth) is private)
+		self.assertEquals(cache.get_stats()["entries"], 0)
+
+		for directive in ("public, max-age=60", "s-maxage=60", "must-revalidate, max-age=60"):
+			cache.clear()
+			send = FakeSender(FakeResponse(200, [("cache-control", directive)], "shared"))
+			self.request(cache, send, headers=auth)
+			self.assertEquals(self.request(cache, send, headers=auth).read(), "shared")
+			self.assertEquals(len(send.requests), 1)
+
+	def test_private_and_cookies(self):
+		cache = httpcache.HTTPResponseCache()
+		cookie = {"Cookie": "sid=A"}
+		uncacheable = [
+			(FakeResponse(200, [("cache-control", "private, max-age=60")], "private"), {}),
+			(FakeResponse(200, [("cache-control", "public, private, max-age=60")], "private"), cookie),
+			(FakeResponse(200, [("cache-control", "max-age=60")], "data-A"), cookie),
+			(FakeResponse(200, [("cache-control", "max-age=60"), ("set-cookie", "sid=A")], "data-A"), {}) ]
+		for response, headers in uncacheable:
+			self.assertTrue(self.request(cache, FakeSender(response), headers=headers) is response)
+		self.assertEquals(cache.get_stats()["entries"], 0)
+
+		send = FakeSender(FakeResponse(200, [("cache-control", "public, max-age=60")], "shared"))
+		self.request(cache, send, headers=cookie)
+		self.assertEquals(self.request(cache, send, headers={"Cookie": "sid=B"}).read(), "shared")
+		self.assertEquals(len(send.requests), 1)
+
+
+class TestHTTPConnectionPoolCache(unittest.TestCase):
+
+	def setUp(self):
+		self.server = FakeHTTPServer(("127.0.0.1", 0), FakeHTTPHandler)
+		self.server.requests = []
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def test_hit_skips_pool(self):
+		cache = httpcache.HTTPResponseCache()
+		pool = httpconnectionpool.HTTPConnectionPool(response_cache=cache)
+		self.assertTrue(pool.get_response_cache() is cache)
+		port = self.server.server_address[1]
+		self.assertEquals(pool.request("127.0.0.1", port, "GET", "/").read(), "data")
+
+		def _get(host, port=None):
+			raise AssertionError("Cache hit checked out connection")
+		pool.get = _get
+		resp = pool.request("127.0.0.1", port, "GET", "/")
+		self.assertEquals((resp.status, resp.read()), (200, "data"))
+		self.assertEquals(self.server.requests, ["/"])
+		self.assertEquals(cache.get_stats()["hits"], 1)
+		pool.clear()
@@ -193,3 +193,28 @@ class TestLRUCache(unittest.TestCase):
 		self.assertTrue(2 in cache)
 		self.assertTrue(3 in cache)
 		self.assertEquals(cache.keys(), [ 2, 3 ])
+
+	def test_sizefunc_limit(self):
+		cache = lrucache.LRUCache(cache_size=10, sizefunc=len)
+		cache[1] = "aaaa"
+		cache[2] = "bbbb"
+		self.assertEquals(cache.getcursize(), 8)
+		cache[3] = "ccccccc"
+		self.assertEquals(cache.keys(), [ 3 ])
+		self.assertEquals(cache.getcursize(), 7)
+
+	def test_sizefunc_update(self):
+		disposed = set()
+		def _disposefunc(item):
+			disposed.add(item)
+		cache = lrucache.LRUCache(cache_size=10, disposefunc=_disposefunc, sizefunc=len)
+		cache[1] = "aaaa"
+		cache[2] = "bbbb"
+		cache[1] = "aaaaaa"
+		self.assertEquals(cache.keys(), [ 2, 1 ])
+		self.assertEquals(cache.getcursize(), 10)
+		self.assertEquals(disposed, set(["aaaa"]))
+		del cache[2]
+		self.assertEquals(cache.getcursize(), 6)
+		cache.clear()
+		self.assertEquals(cache.getcursize(), 0)
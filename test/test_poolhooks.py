@@ -0,0 +1,159 @@
+import unittest
+import threading
+import time
+
+from connectionpool import connectionpool
+
+
+class FakeException(Exception):
+	pass
+
+
+class FakeCountingConnection(connectionpool.ConnectionWrapper):
+	def __init__(self, conn):
+		connectionpool.ConnectionWrapper.__init__(self, conn)
+		self.checks = 0
+		self.opened = True
+
+	def ok(self):
+		self.checks += 1
+		return self.opened
+
+	def close(self):
+		self.opened = False
+
+
+class FakeConnectionFactory:
+	def __init__(self):
+		self.created = []
+
+	def __call__(self):
+		conn = FakeCountingConnection(len(self.created) + 1)
+		self.created.append(conn)
+		return conn
+
+
+class FakeHooks(connectionpool.PoolHooks):
+	def __init__(self, *args, **kwargs):
+		connectionpool.PoolHooks.__init__(self, *args, **kwargs)
+		self.events = []
+		self.checkin_thread = None
+		self.fail_checkin = False
+
+	def on_create(self, conn):
+		self.events.append(("create", conn.conn))
+
+	def on_checkout(self, conn):
+		self.events.append(("checkout", conn.conn))
+
+	def on_checkin(self, conn):
+		self.checkin_thread = threading.current_thread()
+		self.events.append(("checkin", conn.conn))
+		if self.fail_checkin:
+			raise FakeException()
+
+	def on_discard(self, conn):
+		self.events.append(("discard", conn.conn))
+
+
+class SlowCheckinHooks(FakeHooks):
+	def on_checkin(self, conn):
+		time.sleep(0.05)
+		FakeHooks.on_checkin(self, conn)
+
+
+def _callback(conn):
+	return conn
+
+
+class TestPoolHooks(unittest.TestCase):
+
+	def test_lifecycle(self):
+		hooks = FakeHooks()
+		pool = connectionpool.SingleHostConnectionPool(FakeConnectionFactory(), hooks=hooks)
+		self.assertTrue(pool.get_hooks() is hooks)
+		pool.request(_callback)
+		pool.request(_callback)
+		pool.close()
+		self.assertEquals(hooks.events, [
+			("create", 1), ("checkout", 1), ("checkin", 1),
+			("checkout", 1), ("checkin", 1), ("discard", 1) ])
+
+	def test_validate_every_checkout_by_default(self):
+		factory = FakeConnectionFactory()
+		pool = connectionpool.SingleHostConnectionPool(factory, hooks=connectionpool.PoolHooks())
+		for _ in xrange(3):
+			pool.request(_callback)
+		self.assertEquals(factory.created[0].checks, 2)
+
+	def test_validate_after_uses(self):
+		factory = FakeConnectionFactory()
+		pool = connectionpool.SingleHostConnectionPool(
+			factory, hooks=connectionpool.PoolHooks(validate_idle=60, validate_uses=3))
+		for _ in xrange(7):
+			pool.request(_callback)
+		self.assertEquals(len(factory.created), 1)
+		self.assertEquals(factory.created[0].checks, 2)
+
+	def test_validate_after_idle(self):
+		factory = FakeConnectionFactory()
+		pool = connectionpool.SingleHostConnectionPool(
+			factory, hooks=connectionpool.PoolHooks(validate_idle=0.05))
+		pool.request(_callback)
+		pool.request(_callback)
+		self.assertEquals(factory.created[0].checks, 0)
+		time.sleep(0.1)
+		pool.request(_callback)
+		self.assertEquals(factory.created[0].checks, 1)
+
+	def test_broken_connection_discarded_on_validation(self):
+		factory = FakeConnectionFactory()
+		hooks = FakeHooks(validate_uses=1)
+		pool = connectionpool.SingleHostConnectionPool(factory, hooks=hooks)
+		pool.request(_callback).opened = False
+		self.assertEquals(pool.request(_callback).conn, 2)
+		self.assertTrue(("discard", 1) in hooks.events)
+
+	def test_failed_checkin_discards(self):
+		factory = FakeConnectionFactory()
+		hooks = FakeHooks()
+		hooks.fail_checkin = True
+		pool = connectionpool.SingleHostConnectionPool(factory, hooks=hooks)
+		pool.request(_callback)
+		self.assertEquals(pool.request(_callback).conn, 2)
+		self.assertFalse(factory.created[0].opened)
+
+	def test_failed_create_releases_slot(self):
+		class FailingHooks(connectionpool.PoolHooks):
+			def on_create(self, conn):
+				raise FakeException()
+
+		factory = FakeConnectionFactory()
+		pool = connectionpool.SingleHostConnectionPool(factory, hooks=FailingHooks())
+		self.assertRaises(FakeException, lambda: pool.request(_callback))
+		self.assertRaises(FakeException, lambda: pool.request(_callback))
+		self.assertFalse(factory.created[0].opened)
+
+	def test_async_checkin(self):
+		factory = FakeConnectionFactory()
+		hooks = FakeHooks(async_checkin=True)
+		pool = connectionpool.SingleHostConnectionPool(factory, pool_size=1, pool_block=True, hooks=hooks)
+		for _ in xrange(3):
+			self.assertEquals(pool.request(_callback).conn, 1)
+		self.assertTrue(hooks.checkin_thread is not threading.current_thread())
+		pool.close()
+
+	def test_async_checkin_without_pool_block(self):
+		factory = FakeConnectionFactory()
+		hooks = SlowCheckinHooks(async_checkin=True)
+		pool = connectionpool.SingleHostConnectionPool(factory, pool_size=1, hooks=hooks)
+		# Next request waits for checkin instead of finding pool empty
+		for _ in xrange(3):
+			self.assertEquals(pool.request(_callback).conn, 1)
+		self.assertEquals(len(factory.created), 1)
+		pool.close()
+
+	def test_connection_pool_passes_hooks(self):
+		hooks = FakeHooks()
+		pool = connectionpool.ConnectionPool(lambda host, port: FakeCountingConnection(host), hooks=hooks)
+		self.assertTrue(pool.get("host").get_hooks() is hooks)
@@ -0,0 +1,113 @@
+import unittest
+import socket
+import time
+
+from connectionpool import connectionpool
+from connectionpool import replicaset
+
+
+class FakeConnectionFactory:
+	def __init__(self):
+		self.counter = 0
+
+	def __call__(self, host, port):
+		self.counter += 1
+		return connectionpool.ConnectionWrapper((host, port))
+
+
+class TestReplicaSetPool(unittest.TestCase):
+
+	REPLICAS = [("host1", 80), ("host2", 80)]
+
+	def test_init_with_defaults(self):
+		pool = replicaset.ReplicaSetPool(FakeConnectionFactory(), self.REPLICAS)
+		self.assertEquals(pool.get_replicas(), self.REPLICAS)
+		self.assertEquals(
+			pool.get_stats(),
+			[(("host1", 80), 0, 0.0, True), (("host2", 80), 0, 0.0, True)])
+
+	def test_init_validation(self):
+		self.assertRaises(ValueError, lambda: replicaset.ReplicaSetPool(FakeConnectionFactory(), []))
+		self.assertRaises(
+			ValueError,
+			lambda: replicaset.ReplicaSetPool(FakeConnectionFactory(), self.REPLICAS, balancer="random"))
+
+	def test_busy_replica_is_avoided(self):
+		for balancer in (replicaset.ReplicaSetPool.LEAST_OUTSTANDING, replicaset.ReplicaSetPool.TWO_CHOICES):
+			pool = replicaset.ReplicaSetPool(FakeConnectionFactory(), self.REPLICAS, balancer=balancer)
+
+			def _callback(conn):
+				# first replica is still busy with outer request
+				inner = pool.request(lambda inner_conn: inner_conn.conn)
+				self.assertNotEquals(inner, conn.conn)
+				return conn.conn
+			pool.request(_callback)
+
+	def test_slow_replica_is_avoided(self):
+		for balancer in (replicaset.ReplicaSetPool.LEAST_OUTSTANDING, replicaset.ReplicaSetPool.TWO_CHOICES):
+			pool = replicaset.ReplicaSetPool(FakeConnectionFactory(), self.REPLICAS, balancer=balancer)
+
+			def _callback(conn):
+				if conn.conn == ("host1", 80):
+					time.sleep(0.02)
+				return conn.conn
+			self.assertEquals(
+				set([pool.request(_callback), pool.request(_callback)]), set(self.REPLICAS))
+			for _ in xrange(10):
+				self.assertEquals(pool.request(_callback), ("host2", 80))
+
+	def test_slow_replica_recovers(self):
+		for balancer in (replicaset.ReplicaSetPool.LEAST_OUTSTANDING, replicaset.ReplicaSetPool.TWO_CHOICES):
+			pool = replicaset.ReplicaSetPool(
+				FakeConnectionFactory(), self.REPLICAS, balancer=balancer, latency_half_life=0.01)
+			slow = [True]
+
+			def _callback(conn):
+				# one slow response on first replica only
+				if conn.conn == ("host1", 80) and slow:
+					slow.pop()
+					time.sleep(0.05)
+				return conn.conn
+			used = set()
+			for _ in xrange(100):
+				replica = pool.request(_callback)
+				if not slow:
+					used.add(replica)
+				time.sleep(0.002)
+			self.assertFalse(slow)
+			# first replica got requests again after the slow one
+			self.assertEquals(used, set(self.REPLICAS))
+			self.assertTrue(pool.get_stats()[0][2] < 0.05)
+
+	def test_failing_replica_is_dropped(self):
+		pool = replicaset.ReplicaSetPool(FakeConnectionFactory(), self.REPLICAS, fail_timeout=60)
+
+		def _failcallback(conn):
+			raise socket.error("Connection refused")
+
+		self.assertRaises(socket.error, lambda: pool.request(_failcallback))
+		failed = [ key for key, _, _, up in pool.get_stats() if not up ]
+		self.assertEquals(len(failed), 1)
+		for _ in xrange(10):
+			self.assertNotEquals(pool.request(lambda conn: conn.conn), failed[0])
+
+	def test_all_replicas_failing(self):
+		pool = replicaset.ReplicaSetPool(FakeConnectionFactory(), self.REPLICAS, fail_timeout=60)
+
+		def _failcallback(conn):
+			raise socket.error("Connection refused")
+
+		for _ in xrange(2):
+			self.assertRaises(socket.error, lambda: pool.request(_failcallback))
+		self.assertTrue(pool.request(lambda conn: conn.conn) in self.REPLICAS)
+		self.assertEquals([ up for _, _, _, up in pool.get_stats() ].count(True), 1)
+
+	def test_callback_error_keeps_replica(self):
+		pool = replicaset.ReplicaSetPool(FakeConnectionFactory(), self.REPLICAS)
+
+		def _callback(conn):
+			raise KeyError()
+
+		self.assertRaises(KeyError, lambda: pool.request(_callback))
+		self.assertEquals([ up for _, _, _, up in pool.get_stats() ], [True, True])
+		self.assertEquals([ outstanding for _, outstanding, _, _ in pool.get_stats() ], [0, 0])
@@ -0,0 +1,161 @@
+import unittest
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+
+from connectionpool import connectionpool
+from connectionpool import httpconnectionpool
+from connectionpool import singleflight
+
+
+class FakeException(Exception):
+	pass
+
+
+class FakeHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def do_GET(self):
+		self.server.requests.append(self.path)
+		time.sleep(0.2)
+		if self.headers.get("If-None-Match") == '"v1"':
+			self.send_response(304)
+			self.end_headers()
+			return
+		body = "{0}:{1}".format(self.path, self.headers.get("Accept"))
+		self.send_response(200)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+class FakeHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+
+def run_concurrently(funcs):
+	results = []
+	def _run(func):
+		try:
+			results.append(func())
+		except Exception as e:
+			results.append(e)
+	threads = [ threading.Thread(target=_run, args=(func,)) for func in funcs ]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join(5)
+	return results
+
+
+class TestSingleFlight(unittest.TestCase):
+
+	def test_concurrent_calls_share_result(self):
+		flight = singleflight.SingleFlight()
+		calls = []
+		def _func():
+			calls.append(1)
+			time.sleep(0.1)
+			return object()
+		results = run_concurrently([lambda: flight.do("key", _func)] * 10)
+		self.assertEquals(len(calls), 1)
+		self.assertEquals(len(set(results)), 1)
+		self.assertEquals(flight.in_flight(), 0)
+
+	def test_concurrent_calls_share_error(self):
+		flight = singleflight.SingleFlight()
+		def _func():
+			time.sleep(0.1)
+			raise FakeException()
+		results = run_concurrently([lambda: flight.do("key", _func)] * 5)
+		self.assertEquals(len(results), 5)
+		self.assertTrue(all(isinstance(r, FakeException) for r in results))
+
+	def test_sequential_calls(self):
+		flight = singleflight.SingleFlight()
+		self.assertEquals(flight.do("key", lambda: 1), 1)
+		self.assertEquals(flight.do("key", lambda: 2), 2)
+		self.assertEquals(flight.do("other", lambda: 3), 3)
+
+	def test_single_host_pool_created_once(self):
+		created = []
+
+		class SlowSingleHostPool(connectionpool.SingleHostConnectionPool):
+			def __init__(self, *args, **kwargs):
+				created.append(self)
+				time.sleep(0.1)
+				connectionpool.SingleHostConnectionPool.__init__(self, *args, **kwargs)
+
+		class FakeConnectionPool(connectionpool.ConnectionPool):
+			SingleHostPoolCls = SlowSingleHostPool
+
+		pool = FakeConnectionPool(connection_factory=None)
+		results = run_concurrently([lambda: pool.get("host")] * 5)
+		self.assertEquals(len(created), 1)
+		self.assertEquals(set(results), set(created))
+
+
+class TestHTTPCoalescing(unittest.TestCase):
+
+	def setUp(self):
+		self.server = FakeHTTPServer(("127.0.0.1", 0), FakeHTTPHandler)
+		self.server.requests = []
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def request(self, pool, url, headers={}):
+		resp = pool.request("127.0.0.1", self.server.server_address[1], "GET", url, headers=headers)
+		return resp.status, resp.read()
+
+	def test_identical_gets_coalesced(self):
+		pool = httpconnectionpool.HTTPConnectionPool(pool_size=1, coalesce=True)
+		results = run_concurrently([lambda: self.request(pool, "/herd")] * 10)
+		self.assertEquals(results, [(200, "/herd:None")] * 10)
+		self.assertEquals(self.server.requests, ["/herd"])
+		pool.clear()
+
+	def test_without_coalescing(self):
+		pool = httpconnectionpool.HTTPConnectionPool(pool_size=1)
+		results = run_concurrently([lambda: self.request(pool, "/herd")] * 5)
+		self.assertTrue(any(isinstance(r, connectionpool.PoolIsEmptyError) for r in results))
+		pool.clear()
+
+	def test_selected_headers_split_key(self):
+		pool = httpconnectionpool.HTTPConnectionPool(coalesce=True, coalesce_headers=["Accept"])
+		results = run_concurrently(
+			[lambda: self.request(pool, "/herd", {"Accept": "html"})] * 3 +
+			[lambda: self.request(pool, "/herd", {"Accept": "json"}), lambda: self.request(pool, "/herd")] * 3)
+		self.assertEquals(
+			sorted(results),
+			[(200, "/herd:None")] * 3 + [(200, "/herd:html")] * 3 + [(200, "/herd:json")] * 3)
+		self.assertEquals(len(self.server.requests), 3)
+		pool.clear()
+
+	def test_credentials_split_key(self):
+		pool = httpconnectionpool.HTTPConnectionPool(coalesce=True)
+		results = run_concurrently(
+			[lambda: self.request(pool, "/herd", {"Authorization": "Basic a"})] * 3 +
+			[lambda: self.request(pool, "/herd", {"Authorization": "Basic b"})] * 3 +
+			[lambda: self.request(pool, "/herd", {"Cookie": "session=c"})] * 3)
+		self.assertEquals(results, [(200, "/herd:None")] * 9)
+		self.assertEquals(len(self.server.requests), 3)
+		pool.clear()
+
+	def test_conditional_requests_not_coalesced(self):
+		pool = httpconnectionpool.HTTPConnectionPool(coalesce=True)
+		results = run_concurrently(
+			[lambda: self.request(pool, "/herd", {"If-None-Match": '"v1"'})] +
+			[lambda: self.request(pool, "/herd")] * 3 +
+			[lambda: self.request(pool, "/herd", {"Range": "bytes=0-1"})])
+		self.assertEquals(sorted(results), [(200, "/herd:None")] * 4 + [(304, "")])
+		self.assertEquals(len(self.server.requests), 3)
+		pool.clear()
@@ -0,0 +1,167 @@
+import unittest
+import threading
+import hashlib
+import mmap
+import tempfile
+import BaseHTTPServer
+import SocketServer
+import StringIO
+
+from connectionpool import connectionpool
+from connectionpool import httpconnectionpool
+from connectionpool import streaming
+
+
+class FakeException(Exception):
+	pass
+
+
+class FakeHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def do_POST(self):
+		if self.headers.get("Transfer-Encoding") == "chunked":
+			framing, body = "chunked", self.read_chunked()
+			if body is None:
+				return
+		else:
+			framing, body = "length", self.rfile.read(int(self.headers["Content-Length"]))
+		self.server.connections.add(self.connection)
+		reply = "{0}:{1}:{2}".format(framing, len(body), hashlib.md5(body).hexdigest())
+		self.send_response(200)
+		self.send_header("Content-Length", str(len(reply)))
+		self.end_headers()
+		self.wfile.write(reply)
+
+	def read_chunked(self):
+		chunks = []
+		while True:
+			line = self.rfile.readline()
+			if not line:
+				# Client gave up in the middle of upload
+				return None
+			size = int(line.strip(), 16)
+			chunks.append(self.rfile.read(size))
+			self.rfile.readline()
+			if size == 0:
+				return "".join(chunks)
+
+	def log_message(self, *args):
+		pass
+
+
+class FakeHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+
+def _expected(framing, data):
+	return "{0}:{1}:{2}".format(framing, len(data), hashlib.md5(data).hexdigest())
+
+
+class TestStreamingUploads(unittest.TestCase):
+
+	def setUp(self):
+		self.server = FakeHTTPServer(("127.0.0.1", 0), FakeHTTPHandler)
+		self.server.connections = set()
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		self.pool = httpconnectionpool.HTTPConnectionPool(pool_size=1, net_timeout=5)
+		self.data = "".join(chr(i) for i in xrange(256)) * 12288 + "tail"
+
+	def tearDown(self):
+		self.pool.clear()
+		self.server.shutdown()
+		self.server.server_close()
+
+	def post(self, body, headers={}):
+		resp = self.pool.request("127.0.0.1", self.server.server_address[1], "POST", "/", body=body, headers=headers)
+		return resp.read()
+
+	def tempfile(self):
+		f = tempfile.TemporaryFile()
+		f.write(self.data)
+		f.flush()
+		return f
+
+	def test_file_body(self):
+		f = self.tempfile()
+		f.seek(7)
+		self.assertEquals(self.post(f), _expected("length", self.data[7:]))
+		self.assertEquals(f.tell(), len(self.data))
+
+	def test_file_body_without_sendfile(self):
+		sendfile, streaming._sendfile = streaming._sendfile, None
+		try:
+			f = self.tempfile()
+			f.seek(0)
+			self.assertEquals(self.post(f), _expected("length", self.data))
+		finally:
+			streaming._sendfile = sendfile
+
+	def test_chunked_file_body(self):
+		f = self.tempfile()
+		f.seek(3)
+		chunked = {"Transfer-Encoding": "chunked"}
+		self.assertEquals(self.post(f, headers=chunked), _expected("chunked", self.data[3:]))
+		sendfile, streaming._sendfile = streaming._sendfile, None
+		try:
+			f.seek(0)
+			self.assertEquals(self.post(f, headers=chunked), _expected("chunked", self.data))
+		finally:
+			streaming._sendfile = sendfile
+		self.assertEquals(self.post(f, headers=chunked), _expected("chunked", ""))
+		self.assertEquals(self.post("abc"), _expected("length", "abc"))
+		self.assertEquals(len(self.server.connections), 1)
+
+	def test_buffer_bodies(self):
+		f = self.tempfile()
+		mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		self.assertEquals(self.post(mm), _expected("length", self.data))
+		self.assertEquals(self.post(memoryview(self.data)[5:]), _expected("length", self.data[5:]))
+		self.assertEquals(self.post(bytearray("abc")), _expected("length", "abc"))
+
+	def test_generator_body(self):
+		chunks = [ self.data[i:i + 100000] for i in xrange(0, len(self.data), 100000) ]
+		self.assertEquals(self.post(chunk for chunk in chunks + [""]), _expected("chunked", self.data))
+		self.assertEquals(self.post(iter(["a", "", "bc"])), _expected("chunked", "abc"))
+
+	def test_file_like_body(self):
+		self.assertEquals(self.post(StringIO.StringIO(self.data)), _expected("chunked", self.data))
+
+	def test_explicit_content_length(self):
+		self.assertEquals(
+			self.post(iter(["ab", "c"]), headers={"Content-Length": "3"}), _expected("length", "abc"))
+
+	def test_connection_held_until_response_read(self):
+		port = self.server.server_address[1]
+		resp = self.pool.request("127.0.0.1", port, "POST", "/", body=iter(["abc"]))
+		self.assertRaises(
+			connectionpool.PoolIsEmptyError,
+			lambda: self.pool.request("127.0.0.1", port, "POST", "/", body=iter(["abc"])))
+		self.assertEquals(resp.read(), _expected("chunked", "abc"))
+		self.assertEquals(self.post(iter(["abc"])), _expected("chunked", "abc"))
+		self.assertEquals(len(self.server.connections), 1)
+
+	def test_failing_generator_discards_connection(self):
+		def _body():
+			yield "abc"
+			raise FakeException()
+		self.assertRaises(FakeException, lambda: self.post(_body()))
+		self.assertEquals(self.post("abc"), _expected("length", "abc"))
+
+	def test_rewind(self):
+		self.assertTrue(streaming.streaming_body("abc") is None)
+		self.assertTrue(streaming.streaming_body(None) is None)
+		body = streaming.streaming_body(iter(["abc"]))
+		self.assertTrue(body.rewind())
+		body.send(FakeSocket(), chunked=True)
+		self.assertFalse(body.rewind())
+
+
+class FakeSocket:
+	def __init__(self):
+		self.sent = []
+
+	def sendall(self, data):
+		self.sent.append(data)
@@ -0,0 +1,189 @@
+import unittest
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from connectionpool import connectionpool
+from connectionpool import httpconnectionpool
+from connectionpool import tracing
+
+
+class FakeException(Exception):
+	pass
+
+
+class FakeConnectionFactory:
+	def __init__(self):
+		self.counter = 0
+
+	def __call__(self):
+		self.counter += 1
+		return connectionpool.ConnectionWrapper(self.counter)
+
+
+class FakeHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def do_GET(self):
+		self.send_response(200)
+		self.send_header("Content-Length", "2")
+		self.end_headers()
+		self.wfile.write("ok")
+
+	def log_message(self, *args):
+		pass
+
+
+class FakeHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+
+class CountingTracer(tracing.Tracer):
+	def __init__(self, *args, **kwargs):
+		tracing.Tracer.__init__(self, *args, **kwargs)
+		self.sampled = []
+
+	def start(self, name, **attributes):
+		trace = tracing.Tracer.start(self, name, **attributes)
+		self.sampled.append(trace is not None)
+		return trace
+
+
+class FakeSpan:
+	def __init__(self, name, start_time, attributes):
+		self.name = name
+		self.start_time = start_time
+		self.attributes = dict(attributes)
+		self.events = []
+		self.end_time = None
+
+	def add_event(self, name, timestamp=None):
+		self.events.append(name)
+
+	def set_attribute(self, key, value):
+		self.attributes[key] = value
+
+	def end(self, end_time=None):
+		self.end_time = end_time
+
+
+class FakeOtelTracer:
+	def __init__(self):
+		self.spans = []
+
+	def start_span(self, name, start_time=None, attributes=None):
+		span = FakeSpan(name, start_time, attributes)
+		self.spans.append(span)
+		return span
+
+
+class TestTracing(unittest.TestCase):
+
+	def test_tracing_disabled(self):
+		pool = connectionpool.SingleHostConnectionPool(connection_factory=FakeConnectionFactory())
+		self.assertEquals(pool.get_tracer(), None)
+		self.assertEquals(pool.request(lambda conn: conn.conn), 1)
+
+	def test_connection_reuse(self):
+		traces = []
+		pool = connectionpool.SingleHostConnectionPool(
+			connection_factory=FakeConnectionFactory(), tracer=tracing.Tracer(traces.append))
+		pool.request(lambda conn: conn.conn)
+		pool.request(lambda conn: conn.conn)
+
+		self.assertEquals([ t.reused for t in traces ], [False, True])
+		self.assertEquals([ p for p, _ in traces[0].phases ], ["pool_wait", "connect"])
+		self.assertEquals([ p for p, _ in traces[1].phases ], ["pool_wait"])
+		for trace in traces:
+			self.assertTrue(trace.end >= trace.start)
+			self.assertTrue(all(d >= 0 for _, d in trace.durations()))
+
+	def test_retries_and_error(self):
+		traces = []
+		pool = connectionpool.SingleHostConnectionPool(
+			connection_factory=FakeConnectionFactory(), tracer=tracing.Tracer(traces.append))
+
+		def _callback(conn):
+			raise connectionpool.PoolBrokenConnectionError(FakeException())
+
+		self.assertRaises(FakeException, lambda: pool.request(_callback))
+		self.assertEquals(len(traces), 1)
+		self.assertEquals(traces[0].retries, 1)
+		self.assertTrue(isinstance(traces[0].error, FakeException))
+
+	def test_sampling(self):
+		traces = []
+		pool = connectionpool.ConnectionPool(
+			connection_factory=lambda host, port: connectionpool.ConnectionWrapper(host),
+			tracer=tracing.Tracer(traces.append, sample_rate=0.0))
+		self.assertEquals(pool.get("host").request(lambda conn: conn.conn), "host")
+		self.assertEquals(traces, [])
+
+	def test_http_phases(self):
+		server = FakeHTTPServer(("127.0.0.1", 0), FakeHTTPHandler)
+		thread = threading.Thread(target=server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+		traces = []
+		pool = httpconnectionpool.HTTPConnectionPool(tracer=tracing.Tracer(traces.append))
+		try:
+			for i in xrange(2):
+				resp = pool.request("127.0.0.1", server.server_address[1], "GET", "/path")
+				self.assertEquals(resp.status, 200)
+				self.assertEquals(len(traces), i) # finished only after body is read
+				self.assertEquals(resp.read(), "ok")
+		finally:
+			pool.clear()
+			server.shutdown()
+			server.server_close()
+
+		self.assertEquals(
+			[ p for p, _ in traces[0].phases ],
+			["pool_wait", "dns", "connect", "send", "first_byte", "body"])
+		self.assertEquals(
+			[ p for p, _ in traces[1].phases ],
+			["pool_wait", "send", "first_byte", "body"])
+		self.assertEquals(traces[0].name, "HTTP GET")
+		self.assertEquals(traces[0].attributes, {"http.method": "GET", "http.url": "/path"})
+		self.assertEquals([ t.reused for t in traces ], [False, True])
+
+	def test_http_sampling(self):
+		server = FakeHTTPServer(("127.0.0.1", 0), FakeHTTPHandler)
+		thread = threading.Thread(target=server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+		traces = []
+		tracer = CountingTracer(traces.append, sample_rate=0.5)
+		pool = httpconnectionpool.HTTPConnectionPool(tracer=tracer)
+		try:
+			for _ in xrange(40):
+				resp = pool.request("127.0.0.1", server.server_address[1], "GET", "/path")
+				self.assertEquals(resp.read(), "ok")
+		finally:
+			pool.clear()
+			server.shutdown()
+			server.server_close()
+
+		# Each request is sampled exactly once, by HTTP layer
+		self.assertEquals(len(tracer.sampled), 40)
+		self.assertEquals(len(traces), tracer.sampled.count(True))
+		self.assertTrue(all(t.name == "HTTP GET" for t in traces))
+
+	def test_opentelemetry_export(self):
+		otel_tracer = FakeOtelTracer()
+		pool = connectionpool.SingleHostConnectionPool(
+			connection_factory=FakeConnectionFactory(),
+			tracer=tracing.OpenTelemetryTracer(otel_tracer))
+
+		def _callback(conn):
+			raise FakeException()
+
+		self.assertRaises(FakeException, lambda: pool.request(_callback))
+		span = otel_tracer.spans[0]
+		self.assertEquals(span.name, "request")
+		self.assertEquals(span.events, ["pool_wait", "connect"])
+		self.assertEquals(
+			span.attributes, {"pool.retries": 0, "pool.reused": False, "error": True})
+		self.assertTrue(span.end_time >= span.start_time)